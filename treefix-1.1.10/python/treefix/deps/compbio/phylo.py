@@ -5,6 +5,8 @@
 
 
 # python imports
+import array
+import cPickle
 import math
 import os
 import random
@@ -19,6 +21,13 @@ from rasmus import util
 # compbio imports
 from . import fasta
 
+# numpy support (for batch reconciliation)
+try:
+    import numpy
+    numpy
+except ImportError:
+    numpy = None
+
 
 #=============================================================================
 # Counting functions
@@ -51,32 +60,72 @@ def make_gene2species(maps):
     """Returns a function that maps gene names to species names
 
     maps -- a list of tuples [(gene_pattern, species_name), ... ]
+
+    Patterns 'prefix*' and '*suffix' are tried before exact names, and the
+    first matching pattern (in order of appearance) wins.  The patterns are
+    compiled into a prefix trie and a suffix trie, and the species of each
+    gene name is cached.
     """
 
     # find exact matches and expressions
     exacts = {}
-    exps = []
-    for mapping in maps:
-        if "*" not in mapping[0]:
-            exacts[mapping[0]] = mapping[1]
+    prefixes = {}   # trie of prefixes
+    suffixes = {}   # trie of reversed suffixes
+    for i, mapping in enumerate(maps):
+        exp = mapping[0]
+        if "*" not in exp:
+            exacts[exp] = mapping[1]
+            continue
+        elif exp[-1] == "*":
+            node, chars = prefixes, exp[:-1]
+        elif exp[0] == "*":
+            node, chars = suffixes, reversed(exp[1:])
         else:
-            exps.append(mapping)
+            # never matches
+            continue
+
+        # the key None of a trie node holds the first pattern ending there
+        for c in chars:
+            node = node.setdefault(c, {})
+        if None not in node:
+            node[None] = (i, mapping[1])
+
+    def match_trie(trie, chars):
+        """Returns the first pattern of a trie that matches chars"""
+        node = trie
+        best = node.get(None)
+        for c in chars:
+            node = node.get(c)
+            if node is None:
+                break
+            match = node.get(None)
+            if match is not None and (best is None or match < best):
+                best = match
+        return best
+
+    cache = {}
 
     # create mapping function
     def gene2species(gene):
+        try:
+            return cache[gene]
+        except KeyError:
+            pass
+
         # eval expressions first in order of appearance
-        for exp, species in exps:
-            if exp[-1] == "*":
-                if gene.startswith(exp[:-1]):
-                    return species
-            elif exp[0] == "*":
-                if gene.endswith(exp[1:]):
-                    return species
-
-        if gene in exacts:
-            return exacts[gene]
-
-        raise Exception("Cannot map gene '%s' to any species" % gene)
+        match = match_trie(prefixes, gene)
+        match2 = match_trie(suffixes, reversed(gene))
+        if match2 is not None and (match is None or match2 < match):
+            match = match2
+        if match is not None:
+            species = match[1]
+        elif gene in exacts:
+            species = exacts[gene]
+        else:
+            raise Exception("Cannot map gene '%s' to any species" % gene)
+
+        cache[gene] = species
+        return species
     return gene2species
 
 
@@ -100,34 +149,34 @@ def read_gene2species(* filenames):
 #
 
 
-def reconcile(gtree, stree, gene2species=gene2species):
+def reconcile(gtree, stree, gene2species=gene2species, lca_index=None):
     """
     Returns a reconciliation dict for a gene tree 'gtree' and species tree 'stree'
+
+    lca_index -- optional treelib.LCAIndex of stree (built once per species
+                 tree) for constant-time LCA queries
     """
 
     recon = {}
 
-    # determine the preorder traversal of the stree
-    order = {}
-    def walk(node):
-        order[node] = len(order)
-        node.recurse(walk)
-    walk(stree.root)
-
+    if lca_index is not None:
+        lca = lca_index.lca
+    else:
+        # determine the preorder traversal of the stree
+        order = {}
+        for node in stree.preorder():
+            order[node] = len(order)
+        lca = lambda nodes: reconcile_lca(stree, order, nodes)
 
     # label gene leaves with their species
     for node in gtree.leaves():
         recon[node] = stree.nodes[gene2species(node.name)]
 
-    # recurse through gene tree
-    def walk(node):
-        node.recurse(walk)
-
+    # visit gene tree in postorder
+    for node in gtree.postorder():
         if not node.is_leaf():
             # this node's species is lca of children species
-            recon[node] = reconcile_lca(stree, order,
-                                       util.mget(recon, node.children))
-    walk(gtree.root)
+            recon[node] = lca(util.mget(recon, node.children))
 
     return recon
 
@@ -156,9 +205,9 @@ def reconcile_lca(stree, order, nodes):
     return node1
 
 
-def reconcile_node(node, stree, recon):
+def reconcile_node(node, stree, recon, lca_index=None):
     """Reconcile a single gene node to a species node"""
-    return treelib.lca([recon[x] for x in node.children])
+    return treelib.lca([recon[x] for x in node.children], lca_index)
 
 
 def assert_recon(tree, stree, recon):
@@ -189,10 +238,8 @@ def label_events(gtree, recon):
        'gene', 'spec', or 'dup'"""
     events = {}
 
-    def walk(node):
+    for node in gtree.preorder():
         events[node] = label_events_node(node, recon)
-        node.recurse(walk)
-    walk(gtree.root)
 
     return events
 
@@ -241,6 +288,31 @@ def find_loss_node(node, recon):
     return loss
 
 
+def count_loss_node(node, recon, depths, events=None):
+    """
+    Returns the number of losses on the branch above a node of a gene tree,
+    without listing them (see find_loss_node)
+
+    depths -- depth of each species node (e.g. treelib.LCAIndex.depths)
+              of a binary species tree
+    events -- optional events of the gene tree
+    """
+    parent = node.parent
+    if not parent:
+        return 0
+
+    # one loss per species node between recon[node] and recon[parent],
+    # and one at recon[parent] unless the parent is a duplication
+    nloss = depths[recon[node]] - depths[recon[parent]]
+    if events is not None:
+        event = events[parent]
+    else:
+        event = label_events_node(parent, recon)
+    if event != "dup":
+        nloss -= 1
+    return nloss
+
+
 def find_loss_under_node(node, recon):
     loss = []
     snodes = {}
@@ -273,7 +345,7 @@ def find_loss(gtree, stree, recon, node=None):
     """
     loss = []
 
-    def walk(node):
+    for node in gtree.preorder(node):
         loss.extend(find_loss_node(node, recon))
 
         # add losses (for non-MPR)
@@ -286,12 +358,6 @@ def find_loss(gtree, stree, recon, node=None):
         #    if child_snode not in child_snodes:
         #        loss.append([node, child_snode])
 
-        node.recurse(walk)
-    if node:
-        walk(node)
-    else:
-        walk(gtree.root)
-
     return loss
 
 
@@ -301,23 +367,30 @@ def count_dup(gtree, events, node=None):
     TODO: generalize to non-MPR events
           (in particular, to handle duplication followed immediately by loss)
     """
-    var = {"dups": 0}
+    dups = 0
 
-    def walk(node):
+    for node in gtree.preorder(node):
         if events[node] == "dup":
-            var["dups"] += len(node.children) - 1
-        node.recurse(walk)
-    if node:
-        walk(node)
-    else:
-        walk(gtree.root)
+            dups += len(node.children) - 1
+
+    return dups
 
-    return var["dups"]
 
+def count_loss(gtree, stree, recon, node=None, depths=None, events=None):
+    """
+    Returns the number of losses in a gene tree
+
+    depths -- optional depth of each species node (e.g. treelib.LCAIndex.depths)
+              to count losses without listing them (binary species trees only)
+    events -- optional events of the gene tree (used with depths)
+    """
+    if depths is None:
+        return len(find_loss(gtree, stree, recon, node))
 
-def count_loss(gtree, stree, recon, node=None):
-    """Returns the number of losses in a gene tree"""
-    return len(find_loss(gtree, stree, recon, node))
+    nloss = 0
+    for node in gtree.preorder(node):
+        nloss += count_loss_node(node, recon, depths, events)
+    return nloss
 
 
 def count_dup_loss(gtree, stree, recon, events=None):
@@ -335,15 +408,15 @@ def find_species_roots(tree, stree, recon):
        species tree root"""
 
     roots = []
-    def walk(node):
-        found = False
+    found = {}
+    for node in tree.postorder():
+        found2 = False
         for child in node.children:
-            found = walk(child) or found
-        if not found and recon[node] == stree.root:
+            found2 = found.pop(child) or found2
+        if not found2 and recon[node] == stree.root:
             roots.append(node)
-            found = True
-        return found
-    walk(tree.root)
+            found2 = True
+        found[node] = found2
     return roots
 
 
@@ -501,13 +574,11 @@ def read_recon_events(filename, tree1, tree2):
 
 def init_dup_loss_tree(stree):
     # initalize counts to zero
-    def walk(node):
+    for node in stree.preorder():
         node.data['dup'] = 0
         node.data['loss'] = 0
         node.data['appear'] = 0
         node.data['genes'] = 0
-        node.recurse(walk)
-    walk(stree.root)
 
 
 def count_dup_loss_tree(tree, stree, gene2species, recon=None, events=None):
@@ -548,18 +619,16 @@ def count_dup_loss_tree(tree, stree, gene2species, recon=None, events=None):
 
 def count_ancestral_genes(stree):
     """count ancestral genes"""
-    def walk(node):
+    for node in stree.postorder():
         if not node.is_leaf():
             counts = []
             for child in node.children:
-                walk(child)
                 counts.append(child.data['genes']
                               - child.data['appear']
                               - child.data['dup']
                               + child.data['loss'])
             assert util.equal(* counts), (node.name, str(counts))
             node.data['genes'] = counts[0]
-    walk(stree.root)
 
 
 def count_dup_loss_trees(trees, stree, gene2species):
@@ -601,9 +670,7 @@ def dup_consistency(tree, recon, events):
         return {}
 
     spset = {}
-    def walk(node):
-        for child in node.children:
-            walk(child)
+    for node in tree.postorder():
         if node.is_leaf():
             spset[node] = set([recon[node]])
         elif len(node.children) == 1:
@@ -613,7 +680,6 @@ def dup_consistency(tree, recon, events):
                            spset[node.children[1]])
         else:
             raise Exception("too many children (%d)" % len(node.children))
-    walk(tree.root)
 
     conf = {}
     for node in tree:
@@ -639,6 +705,518 @@ def fix_ils_errors(events, dupcons, newCopy=True):
     return events
 
 
+#=============================================================================
+# species tree index
+#
+# Facts of a species tree shared by the reconciliation cost models.  The
+# index is built once per species tree and can be kept in a cache file
+# next to the species tree file.
+#
+
+SPECIES_TREE_INDEX_VERSION = 1
+
+
+class SpeciesTreeIndex (treelib.LCAIndex):
+    """
+    LCA index of a species tree with preorder and postorder ids, the
+    bitset and number of leaves below each node, and the node of each
+    species name (the targets of a species map)
+    """
+
+    def __init__(self, tree, tables=None):
+        """
+        tables -- optional tables of an identical tree from get_tables()
+                  (see read_species_tree_index)
+        """
+        self.nodes = list(tree.preorder())
+        self.ids = dict((node, i) for i, node in enumerate(self.nodes))
+        self.postorder_ids = dict((node, i)
+                                  for i, node in enumerate(tree.postorder()))
+        self.species = dict((node.name, node) for node in self.nodes)
+
+        if tables is None:
+            treelib.LCAIndex.__init__(self, tree)
+
+            # leaf i in preorder is bit i of the leaf sets
+            self.leafsets = {}
+            nleaves = 0
+            for node in self.nodes:
+                if node.is_leaf():
+                    self.leafsets[node] = 1 << nleaves
+                    nleaves += 1
+            for node in tree.postorder():
+                if not node.is_leaf():
+                    leafset = 0
+                    for child in node.children:
+                        leafset |= self.leafsets[child]
+                    self.leafsets[node] = leafset
+        else:
+            nodes = self.nodes
+            self.tree = tree
+            self.depths = dict(zip(nodes, tables["depths"]))
+            self.first = dict(zip(nodes, tables["first"]))
+            self.tour = [nodes[i] for i in tables["tour"]]
+            self.tour_depths = tables["tour_depths"]
+            self.sparse = tables["sparse"]
+            self.leafsets = dict(zip(nodes, tables["leafsets"]))
+
+        self.sizes = dict((node, bin(leafset).count("1"))
+                          for node, leafset in self.leafsets.iteritems())
+
+    def get_tables(self):
+        """Returns the tables of the index by preorder id"""
+        ids = self.ids
+        return {"version": SPECIES_TREE_INDEX_VERSION,
+                "key": species_tree_key(self.tree),
+                "depths": [self.depths[node] for node in self.nodes],
+                "first": [self.first[node] for node in self.nodes],
+                "tour": [ids[node] for node in self.tour],
+                "tour_depths": self.tour_depths,
+                "sparse": self.sparse,
+                "leafsets": [self.leafsets[node] for node in self.nodes]}
+
+
+def species_tree_key(stree):
+    """
+    Returns the names and parent preorder ids of the nodes of a species
+    tree in preorder (identifies the tree of a saved index)
+    """
+    ids = {}
+    key = []
+    for node in stree.preorder():
+        ids[node] = len(ids)
+        key.append((node.name, ids[node.parent] if node.parent else -1))
+    return key
+
+
+def write_species_tree_index(index, filename):
+    """
+    Writes a SpeciesTreeIndex to a file
+
+    The file is replaced atomically so that concurrent runs never read
+    a partial file.
+    """
+    tmpfile = "%s.%d.tmp" % (filename, os.getpid())
+    out = open(tmpfile, "wb")
+    try:
+        cPickle.dump(index.get_tables(), out, cPickle.HIGHEST_PROTOCOL)
+    finally:
+        out.close()
+    os.rename(tmpfile, filename)
+
+
+def read_species_tree_index(stree, filename):
+    """
+    Returns the SpeciesTreeIndex of 'stree' saved in a file, or None if
+    the file is missing, unreadable, or was saved for a different tree
+    """
+    try:
+        infile = open(filename, "rb")
+        try:
+            tables = cPickle.load(infile)
+        finally:
+            infile.close()
+    except Exception:
+        return None
+
+    if not isinstance(tables, dict) or \
+       tables.get("version") != SPECIES_TREE_INDEX_VERSION or \
+       tables.get("key") != species_tree_key(stree):
+        return None
+    return SpeciesTreeIndex(stree, tables)
+
+
+def get_species_tree_index(stree, filename=None):
+    """
+    Returns a SpeciesTreeIndex of 'stree'
+
+    If 'filename' is given, the index is read from that cache file if it
+    is current, and otherwise built and saved to it (failures to save are
+    ignored).
+    """
+    if filename is None:
+        return SpeciesTreeIndex(stree)
+
+    index = read_species_tree_index(stree, filename)
+    if index is None:
+        index = SpeciesTreeIndex(stree)
+        try:
+            write_species_tree_index(index, filename)
+        except (IOError, OSError):
+            pass
+    return index
+
+
+#=============================================================================
+# compact tree reconciliation
+#
+# Species tree nodes are numbered in preorder and compact gene trees
+# (treelib.CompactTree) keep the species id of each leaf, so reconciliation,
+# event labeling, and loss counting only use integers.
+#
+
+
+class CompactSpeciesTree (object):
+    """Integer ids, LCA queries, and loss path sums of a species tree"""
+
+    def __init__(self, stree, lca_index=None):
+        if lca_index is None:
+            lca_index = treelib.LCAIndex(stree)
+
+        self.tree = stree
+        if isinstance(lca_index, SpeciesTreeIndex):
+            self.nodes = lca_index.nodes
+            self.ids = lca_index.ids
+        else:
+            self.nodes = list(stree.preorder())
+            self.ids = dict((node, i) for i, node in enumerate(self.nodes))
+        self.parent = [self.ids[node.parent] if node.parent else -1
+                       for node in self.nodes]
+        self.depths = [lca_index.depths[node] for node in self.nodes]
+        self.lca_index = lca_index.relabel(self.ids)
+        self.lca = self.lca_index.lca_pair
+        self._lca_tables = None
+
+        # path_loss[s] is the number of species branches that leave the path
+        # from the root to s (inclusive) and parent_loss[s] is the same for
+        # the parent of s, so that the losses on a gene branch are
+        # differences of these sums
+        self.path_loss = []
+        self.parent_loss = []
+        for i, node in enumerate(self.nodes):
+            above = self.path_loss[self.parent[i]] if node.parent else 0
+            self.parent_loss.append(above)
+            self.path_loss.append(above + len(node.children) - 1)
+
+    def lca_array(self, ids1, ids2):
+        """Returns the LCAs of two NumPy arrays of species ids"""
+        if self._lca_tables is None:
+            index = self.lca_index
+            tour_depths = numpy.array(index.tour_depths, dtype=numpy.intc)
+            sparse = numpy.zeros((len(index.sparse), len(index.tour)),
+                                 dtype=numpy.intc)
+            for k, row in enumerate(index.sparse):
+                sparse[k, :len(row)] = row
+            self._lca_tables = (
+                numpy.array([index.first[i] for i in xrange(len(self.nodes))],
+                            dtype=numpy.intc),
+                numpy.array(index.tour, dtype=numpy.intc),
+                tour_depths, sparse,
+                numpy.array([0] + [n.bit_length() - 1
+                                   for n in xrange(1, len(index.tour) + 1)],
+                            dtype=numpy.intc))
+        first, tour, tour_depths, sparse, logs = self._lca_tables
+
+        i = first[ids1]
+        j = first[ids2]
+        i, j = numpy.minimum(i, j), numpy.maximum(i, j)
+        k = logs[j - i + 1]
+        a = sparse[k, i]
+        b = sparse[k, j - (1 << k) + 1]
+        return tour[numpy.where(tour_depths[a] <= tour_depths[b], a, b)]
+
+
+def compact_gene_tree(gtree, cstree, gene2species=gene2species):
+    """
+    Returns a treelib.CompactTree of a gene tree with the species id of
+    each leaf, given a CompactSpeciesTree
+    """
+    ctree = treelib.CompactTree(gtree)
+    ids = cstree.ids
+    snodes = cstree.tree.nodes
+    species = array.array("i", [-1]) * len(ctree)
+    for i, name in enumerate(ctree.names):
+        if ctree.is_leaf(i):
+            species[i] = ids[snodes[gene2species(name)]]
+    ctree.species = species
+    return ctree
+
+
+def reconcile_compact(ctree, cstree):
+    """
+    Returns the reconciliation of a compact gene tree as an array of
+    species ids
+    """
+    recon = array.array("i", ctree.species)
+    left, right = ctree.left, ctree.right
+    lca = cstree.lca
+
+    for node in ctree.postorder():
+        l = left[node]
+        if l != -1:
+            r = right[node]
+            if r != -1:
+                recon[node] = lca(recon[l], recon[r])
+            else:
+                recon[node] = recon[l]
+    return recon
+
+
+def label_events_compact(ctree, recon):
+    """
+    Returns a list with the event ('gene', 'spec', or 'dup') of each node
+    of a compact gene tree
+    """
+    left, right = ctree.left, ctree.right
+    events = []
+    for node in xrange(len(ctree)):
+        l, r = left[node], right[node]
+        if l == -1 and r == -1:
+            events.append("gene")
+        elif recon[node] == recon[l] or (r != -1 and recon[node] == recon[r]):
+            events.append("dup")
+        else:
+            events.append("spec")
+    return events
+
+
+def count_dup_compact(ctree, events):
+    """Returns the number of duplications in a compact gene tree"""
+    right = ctree.right
+    ndups = 0
+    for node, event in enumerate(events):
+        if event == "dup" and right[node] != -1:
+            ndups += 1
+    return ndups
+
+
+def count_loss_compact(ctree, cstree, recon, events):
+    """Returns the number of losses in a compact gene tree"""
+    parent = ctree.parent
+    path_loss, parent_loss = cstree.path_loss, cstree.parent_loss
+    nloss = 0
+    for node in xrange(len(ctree)):
+        p = parent[node]
+        if p == -1:
+            continue
+
+        # the species path from recon[node] up to (but not including)
+        # recon[p] (including recon[p] if p is a duplication)
+        if events[p] == "dup":
+            nloss += parent_loss[recon[node]] - parent_loss[recon[p]]
+        else:
+            nloss += parent_loss[recon[node]] - path_loss[recon[p]]
+    return nloss
+
+
+#=============================================================================
+# batch reconciliation
+#
+# Many gene trees are concatenated into one postorder encoding, so
+# that children always precede their parents, and reconciled level by level
+# (the level of a node is its height above its leaves).  With NumPy, each
+# level is a few array operations over all trees at once; otherwise the
+# encoding is walked node by node.
+#
+
+BATCH_EVENTS = ("gene", "spec", "dup")
+
+
+class TreeBatch (object):
+    """
+    Postorder integer encoding of many binary gene trees
+
+    Positions number the nodes of all trees consecutively, each tree in the
+    order of Tree.postorder().
+
+    offsets -- position of the first node of each tree (and the total size)
+    tree -- index of the tree at each position
+    left, right, parent -- positions of relatives (-1 for none)
+    species -- species id of each leaf (-1 for internal nodes), given by a
+               CompactSpeciesTree
+    heights -- height of each node above its leaves
+    """
+
+    def __init__(self, gtrees, cstree, gene2species=gene2species):
+        self.offsets = array.array("i", [0])
+        self.tree = array.array("i")
+        self.left = array.array("i")
+        self.right = array.array("i")
+        self.parent = array.array("i")
+        self.species = array.array("i")
+        self.heights = array.array("i")
+
+        ids = cstree.ids
+        snodes = cstree.tree.nodes
+        leaf_species = {}   # gene name -> species id
+        left, right, parent = self.left, self.right, self.parent
+        heights = self.heights
+
+        for t, gtree in enumerate(gtrees):
+            pos = {}
+            for node in gtree.postorder():
+                k = len(left)
+                pos[node] = k
+                children = node.children
+                if len(children) == 0:
+                    l = r = -1
+                    species = leaf_species.get(node.name)
+                    if species is None:
+                        species = ids[snodes[gene2species(node.name)]]
+                        leaf_species[node.name] = species
+                    height = 0
+                elif len(children) == 1:
+                    l = pos[children[0]]
+                    r = -1
+                    species = -1
+                    height = heights[l] + 1
+                elif len(children) == 2:
+                    l = pos[children[0]]
+                    r = pos[children[1]]
+                    species = -1
+                    height = max(heights[l], heights[r]) + 1
+                else:
+                    raise Exception("batch gene trees must be binary: node %s" %
+                                    str(node.name))
+                for child in children:
+                    parent[pos[child]] = k
+
+                self.tree.append(t)
+                left.append(l)
+                right.append(r)
+                parent.append(-1)
+                self.species.append(species)
+                heights.append(height)
+            self.offsets.append(len(left))
+
+    def __len__(self):
+        """Returns the number of trees"""
+        return len(self.offsets) - 1
+
+
+def get_batch_recon(batch, t, gtree, cstree, recon, events):
+    """
+    Returns the reconciliation and events (dicts) of tree t of a TreeBatch,
+    given the gene tree it was made from
+    """
+    recon2 = {}
+    events2 = {}
+    for pos, node in enumerate(gtree.postorder(), batch.offsets[t]):
+        recon2[node] = cstree.nodes[recon[pos]]
+        events2[node] = BATCH_EVENTS[events[pos]]
+    return recon2, events2
+
+
+def _batch_arrays(batch):
+    """Returns the encoding of a batch as NumPy arrays"""
+    return [numpy.frombuffer(x, dtype=numpy.intc) if len(x) > 0 else
+            numpy.zeros(0, dtype=numpy.intc)
+            for x in (batch.tree, batch.left, batch.right, batch.parent,
+                      batch.species, batch.heights)]
+
+
+def reconcile_batch(batch, cstree):
+    """
+    Returns the species id of every position of a TreeBatch
+    (a NumPy array if available, otherwise an array.array)
+    """
+    if numpy is None:
+        recon = array.array("i", batch.species)
+        left, right = batch.left, batch.right
+        lca = cstree.lca
+        for node in xrange(len(recon)):
+            l = left[node]
+            if l != -1:
+                r = right[node]
+                if r != -1:
+                    recon[node] = lca(recon[l], recon[r])
+                else:
+                    recon[node] = recon[l]
+        return recon
+
+    tree, left, right, parent, species, heights = _batch_arrays(batch)
+    recon = species.copy()
+    if len(recon) == 0:
+        return recon
+
+    # positions grouped by level
+    order = numpy.argsort(heights, kind="mergesort")
+    bounds = numpy.searchsorted(heights[order],
+                                numpy.arange(heights.max() + 2))
+
+    for h in xrange(1, len(bounds) - 1):
+        nodes = order[bounds[h]:bounds[h+1]]
+        l = recon[left[nodes]]
+        r = right[nodes]
+        r = numpy.where(r != -1, recon[r], l)
+        recon[nodes] = cstree.lca_array(l, r)
+    return recon
+
+
+def label_events_batch(batch, recon):
+    """
+    Returns the event of every position of a TreeBatch as an index into
+    BATCH_EVENTS
+    """
+    if numpy is None:
+        left, right = batch.left, batch.right
+        events = array.array("b", [0]) * len(recon)
+        for node in xrange(len(recon)):
+            l, r = left[node], right[node]
+            if l == -1 and r == -1:
+                continue
+            elif recon[node] == recon[l] or (r != -1 and recon[node] == recon[r]):
+                events[node] = 2
+            else:
+                events[node] = 1
+        return events
+
+    tree, left, right, parent, species, heights = _batch_arrays(batch)
+    events = numpy.zeros(len(recon), dtype=numpy.int8)
+    internal = (left != -1) | (right != -1)
+    dup = (recon == recon[left]) | ((right != -1) & (recon == recon[right]))
+    events[internal] = 1
+    events[internal & dup] = 2
+    return events
+
+
+def count_dup_batch(batch, events):
+    """Returns the number of duplications of each tree of a TreeBatch"""
+    if numpy is None:
+        ndups = [0] * len(batch)
+        tree, right = batch.tree, batch.right
+        for node, event in enumerate(events):
+            if event == 2 and right[node] != -1:
+                ndups[tree[node]] += 1
+        return ndups
+
+    tree, left, right, parent, species, heights = _batch_arrays(batch)
+    dup = (events == 2) & (right != -1)
+    return numpy.bincount(tree[dup], minlength=len(batch)).tolist()
+
+
+def count_loss_batch(batch, cstree, recon, events):
+    """Returns the number of losses of each tree of a TreeBatch"""
+    if numpy is None:
+        nloss = [0] * len(batch)
+        tree, parent = batch.tree, batch.parent
+        path_loss, parent_loss = cstree.path_loss, cstree.parent_loss
+        for node in xrange(len(recon)):
+            p = parent[node]
+            if p == -1:
+                continue
+            if events[p] == 2:
+                n = parent_loss[recon[node]] - parent_loss[recon[p]]
+            else:
+                n = parent_loss[recon[node]] - path_loss[recon[p]]
+            nloss[tree[node]] += n
+        return nloss
+
+    tree, left, right, parent, species, heights = _batch_arrays(batch)
+    path_loss = numpy.array(cstree.path_loss, dtype=numpy.intc)
+    parent_loss = numpy.array(cstree.parent_loss, dtype=numpy.intc)
+
+    # losses on the branch above each non-root position
+    nodes = numpy.nonzero(parent != -1)[0]
+    p = parent[nodes]
+    precon = recon[p]
+    above = numpy.where(events[p] == 2,
+                        parent_loss[precon], path_loss[precon])
+    n = parent_loss[recon[nodes]] - above
+    return numpy.bincount(tree[nodes], weights=n,
+                          minlength=len(batch)).astype(int).tolist()
+
+
 #=============================================================================
 # tree rooting
 
@@ -646,7 +1224,7 @@ def fix_ils_errors(events, dupcons, newCopy=True):
 def recon_root(gtree, stree, gene2species=gene2species,
                rootby="duploss", newCopy=True,
                keepName=False, returnCost=False,
-               dupcost=1, losscost=1):
+               dupcost=1, losscost=1, lca_index=None):
     """
     Reroot a tree by minimizing the number of duplications/losses/both
 
@@ -660,6 +1238,7 @@ def recon_root(gtree, stree, gene2species=gene2species,
     dupcost -- cost of gene duplication
     losscost -- cost of gene loss
     keepName -- if True, reuse existing root name for new root node
+    lca_index -- optional treelib.LCAIndex of stree
     """
     # assert valid inputs
     assert rootby in ["dup", "loss", "duploss"], "unknown rootby value '%s'" % rootby
@@ -671,7 +1250,7 @@ def recon_root(gtree, stree, gene2species=gene2species,
 
     if len(gtree.leaves()) == 2:
         if returnCost:
-            recon = reconcile(gtree, stree, gene2species)
+            recon = reconcile(gtree, stree, gene2species, lca_index)
             events = label_events(gtree, recon)
             cost = 0
             if rootby in ["dup", "duploss"] and dupcost != 0:
@@ -696,26 +1275,15 @@ def recon_root(gtree, stree, gene2species=gene2species,
     # same gene names accurate, hashOrdering must be done, for now.
     hash_order_tree(gtree, gene2species)
 
-    # get list of edges to root on
-    edges = []
-    def walk(node):
-        edges.append((node, node.parent))
-        if not node.is_leaf():
-            node.recurse(walk)
-            edges.append((node, node.parent))
-    for child in gtree.root.children:
-        walk(child)
-
     # try initial root and recon
-    treelib.reroot(gtree, edges[0][0].name, newCopy=False)
+    treelib.reroot(gtree, gtree.root.children[0].name, newCopy=False)
     if keepName:
         gtree.rename(gtree.root.name, oldroot)
-    recon = reconcile(gtree, stree, gene2species)
+    recon = reconcile(gtree, stree, gene2species, lca_index)
     events = label_events(gtree, recon)
 
     # find reconciliation that minimizes dup/loss
-    minroot = edges[0]
-    rootedge = sorted(edges[0])
+    minroot = tuple(gtree.root.children)
     cost = 0
 
     if rootby in ["dup", "duploss"] and dupcost != 0:
@@ -724,58 +1292,55 @@ def recon_root(gtree, stree, gene2species=gene2species,
         cost += count_loss(gtree, stree,  recon) * losscost
     mincost = cost
 
-    # try rooting on everything
-    for edge in edges[1:]:
-        if sorted(edge) == rootedge:
-            continue
-        rootedge = sorted(edge)
-
-        node1, node2 = edge
-        if node1.parent != node2:
-            node1, node2 = node2, node1
-        assert node1.parent == node2, "%s %s" % (node1.name, node2.name)
+    # try rooting on everything (each step only changes node2 and the root)
+    cursor = treelib.RerootCursor(gtree)
+    while True:
+        changed = cursor.peek()
+        if changed is None:
+            break
+        node2, root = changed
 
         # uncount cost
         if rootby in ["dup", "duploss"] and dupcost != 0:
-            if events[gtree.root] == "dup":
+            if events[root] == "dup":
                 cost -= dupcost
             if events[node2] == "dup":
                 cost -= dupcost
         if rootby in ["loss", "duploss"] and losscost != 0:
-            cost -= len(find_loss_under_node(gtree.root, recon)) * losscost
+            cost -= len(find_loss_under_node(root, recon)) * losscost
             cost -= len(find_loss_under_node(node2, recon)) * losscost
 
         # new root and recon
-        treelib.reroot(gtree, node1.name, newCopy=False, keepName=keepName)
+        cursor.next()
 
-        recon[node2] = reconcile_node(node2, stree, recon)
-        recon[gtree.root] = reconcile_node(gtree.root, stree, recon)
+        recon[node2] = reconcile_node(node2, stree, recon, lca_index)
+        recon[root] = reconcile_node(root, stree, recon, lca_index)
         events[node2] = label_events_node(node2, recon)
-        events[gtree.root] = label_events_node(gtree.root, recon)
+        events[root] = label_events_node(root, recon)
 
         if rootby in ["dup", "duploss"] and dupcost != 0:
-            if events[gtree.root] ==  "dup":
+            if events[root] ==  "dup":
                 cost += dupcost
             if events[node2] ==  "dup":
                 cost += dupcost
         if rootby in ["loss", "duploss"] and losscost != 0:
-            cost += len(find_loss_under_node(gtree.root, recon)) * losscost
+            cost += len(find_loss_under_node(root, recon)) * losscost
             cost += len(find_loss_under_node(node2, recon)) * losscost
 
         # keep track of min cost
         if cost < mincost:
             mincost = cost
-            minroot = edge
+            minroot = tuple(root.children)
 
 
     # root tree by minroot
-    if edge != minroot:
+    if set(minroot) != set(gtree.root.children):
         node1, node2 = minroot
         if node1.parent != node2:
             node1, node2 = node2, node1
         assert node1.parent == node2
 
-        treelib.reroot(gtree, node1.name, newCopy=False, keepName=keepName)
+        treelib.reroot(gtree, node1.name, newCopy=False, keepName=True)
 
     if returnCost:
         return gtree, mincost
@@ -909,35 +1474,186 @@ def hash_tree_compose_names(child_hashes, node=None):
      return "(%s)%s" % (",".join(child_hashes), node.name)
 
 def hash_tree(tree, smap=lambda x: x, compose=hash_tree_compose):
-    def walk(node):
-        if node.is_leaf():
-            return smap(node.name)
-        else:
-            child_hashes = map(walk, node.children)
-            child_hashes.sort()
-            return compose(child_hashes, node)
-
     if isinstance(tree, treelib.Tree) or hasattr(tree, "root"):
-        return walk(tree.root)
+        root = tree.root
     elif isinstance(tree, treelib.TreeNode):
-        return walk(tree)
+        root = tree
     else:
         raise Exception("Expected Tree object")
 
+    # children follow their parents in preorder
+    hashes = {}
+    for node in reversed([root] + root.descendants()):
+        if node.is_leaf():
+            hashes[node] = smap(node.name)
+        else:
+            child_hashes = [hashes.pop(child) for child in node.children]
+            child_hashes.sort()
+            hashes[node] = compose(child_hashes, node)
+    return hashes[root]
+
 def hash_tree_names(tree, smap=lambda x: x, compose=hash_tree_compose_names):
     return hash_tree(tree, smap, compose)
 
 def hash_order_tree(tree, smap = lambda x: x):
-    def walk(node):
+    # children follow their parents in preorder
+    hashes = {}
+    for node in reversed([tree.root] + tree.root.descendants()):
         if node.is_leaf():
-            return smap(node.name)
+            hashes[node] = smap(node.name)
         else:
-            child_hashes = map(walk, node.children)
+            child_hashes = [hashes.pop(child) for child in node.children]
             ind = util.sortindex(child_hashes)
             child_hashes = util.mget(child_hashes, ind)
             node.children = util.mget(node.children, ind)
-            return hash_tree_compose(child_hashes)
-    walk(tree.root)
+            hashes[node] = hash_tree_compose(child_hashes)
+
+
+#=============================================================================
+# Tree fingerprints
+#
+# A fingerprint is a fixed-width hash of a tree topology.  Each leaf has a
+# random 64-bit key and the key of a cluster (the leaves below a node) is the
+# XOR of its leaf keys.  The rooted fingerprint is the sum of the scrambled
+# cluster keys.  The unrooted fingerprint sums the scrambled keys of the
+# bipartitions (the smaller of a cluster key and its complement), so it does
+# not depend on where the tree is rooted.
+#
+
+FINGERPRINT_MASK = (1 << 64) - 1
+
+
+def make_fingerprint_keys(names, seed=0):
+    """Returns a dict of random 64-bit keys for the leaf names"""
+    rand = random.Random(seed)
+    return dict((name, rand.getrandbits(64)) for name in sorted(names))
+
+
+def scramble_fingerprint_key(key):
+    """Scrambles a cluster key so that fingerprint sums do not cancel"""
+    key = ((key ^ (key >> 30)) * 0xbf58476d1ce4e5b9) & FINGERPRINT_MASK
+    key = ((key ^ (key >> 27)) * 0x94d049bb133111eb) & FINGERPRINT_MASK
+    return key ^ (key >> 31)
+
+
+def fingerprint_clusters(tree, keys):
+    """Returns a dict of cluster keys for every node in the tree"""
+    clusters = {}
+    for node in tree.postorder():
+        if node.is_leaf():
+            clusters[node] = keys[node.name]
+        else:
+            key = 0
+            for child in node.children:
+                key ^= clusters[child]
+            clusters[node] = key
+    return clusters
+
+
+def fingerprint_node(node, clusters, total):
+    """
+    Returns the (rooted, unrooted) fingerprint terms of a node, where 'total'
+    is the cluster key of the root.
+    """
+
+    # leaves and root are the same in every topology
+    if node.is_leaf() or node.parent is None:
+        return 0, 0
+
+    key = clusters[node]
+    rooted = scramble_fingerprint_key(key)
+
+    # the two branches of a binary root are a single bipartition,
+    # which is trivial if either side is a leaf
+    root = node.parent
+    if root.parent is None and len(root.children) == 2 and \
+       (node != root.children[0] or root.children[1].is_leaf()):
+        return rooted, 0
+
+    return rooted, scramble_fingerprint_key(min(key, total ^ key))
+
+
+def hash_tree_fingerprint(tree, keys, rooted=False):
+    """
+    Returns the fingerprint of a tree given the leaf keys from
+    make_fingerprint_keys
+    """
+    clusters = fingerprint_clusters(tree, keys)
+    total = clusters[tree.root]
+    h = 0
+    for node in tree:
+        h += fingerprint_node(node, clusters, total)[0 if rooted else 1]
+    return h & FINGERPRINT_MASK
+
+
+class TreeFingerprint (object):
+    """
+    Fingerprints of a tree that is changed in place by local moves
+
+    The current fingerprints are in 'rooted' and 'unrooted'.
+    """
+
+    def __init__(self, tree, keys):
+        self.keys = keys
+        self.set_tree(tree)
+
+    def set_tree(self, tree):
+        self.tree = tree
+        self.clusters = fingerprint_clusters(tree, self.keys)
+        self.total = self.clusters[tree.root]
+        self.terms = {}
+        rooted = unrooted = 0
+        for node in tree:
+            self.terms[node] = terms = fingerprint_node(node, self.clusters,
+                                                        self.total)
+            rooted += terms[0]
+            unrooted += terms[1]
+        self.rooted = rooted & FINGERPRINT_MASK
+        self.unrooted = unrooted & FINGERPRINT_MASK
+        self.undo = None
+
+    def update(self, move):
+        """
+        Updates the fingerprints after a local move, given as the 'last_move'
+        of a TreeSearch
+        """
+        clusters, terms = self.clusters, self.terms
+
+        # clusters change on the path to the root, and terms also change
+        # for nodes that have a new parent
+        nodes = find_changed_ancestors(move[1])
+        tnodes = set(nodes)
+        for node in move[1]:
+            tnodes.update(node.children)
+        self.undo = ([(node, clusters[node]) for node in nodes],
+                     [(node, terms[node]) for node in tnodes],
+                     self.rooted, self.unrooted)
+
+        for node in nodes:
+            key = 0
+            for child in node.children:
+                key ^= clusters[child]
+            clusters[node] = key
+
+        rooted, unrooted = self.rooted, self.unrooted
+        for node in tnodes:
+            old = terms[node]
+            terms[node] = new = fingerprint_node(node, clusters, self.total)
+            rooted += new[0] - old[0]
+            unrooted += new[1] - old[1]
+        self.rooted = rooted & FINGERPRINT_MASK
+        self.unrooted = unrooted & FINGERPRINT_MASK
+
+    def revert(self):
+        """Undoes the last update"""
+        if self.undo is None:
+            return
+        clusters, terms, self.rooted, self.unrooted = self.undo
+        for node, key in clusters:
+            self.clusters[node] = key
+        for node, term in terms:
+            self.terms[node] = term
+        self.undo = None
 
 
 #=============================================================================
@@ -1503,6 +2219,8 @@ def perform_nni(tree, node1, node2, change=0, rooted=True):
         if node2.children[uncle] == node1:
             uncle = 1
 
+    tree.record(node1, node2, node1.children[change], node2.children[uncle])
+
     # swap parent pointers
     node1.children[change].parent = node2
     node2.children[uncle].parent = node1
@@ -1581,6 +2299,8 @@ def perform_spr(tree, subtree, newpos):
     d = e.parent
     ei = 0 if d.children[0] == e else 1
 
+    tree.record(b, c, d, e, f)
+
     d.children[ei] = c
     c.children[bi] = e
     f.children[ci] = b
@@ -1686,13 +2406,57 @@ def propose_random_spr(tree):
     return subtree, newpos
 
 
+def perform_move(tree, move):
+    """
+    Performs a local move given as a tuple of its kind and arguments, with
+    nodes given by name (see TreeSearch.moves)
+    """
+    kind = move[0]
+    if kind == "nni":
+        perform_nni(tree, tree.nodes[move[1]], tree.nodes[move[2]], move[3])
+    elif kind == "spr":
+        perform_spr(tree, tree.nodes[move[1]], tree.nodes[move[2]])
+    else:
+        raise Exception("unknown move '%s'" % kind)
+
+
+def find_changed_ancestors(nodes):
+    """
+    Returns the nodes changed by a local move together with their ancestors,
+    ordered so that every node comes before its parent
+    """
+    depths = {}
+    for node in nodes:
+        path = []
+        while node is not None and node not in depths:
+            path.append(node)
+            node = node.parent
+        depth = depths[node] if node is not None else -1
+        for node in reversed(path):
+            depth += 1
+            depths[node] = depth
+    return sorted(depths, key=lambda node: -depths[node])
+
+
 #=============================================================================
 # tree search
 
 class TreeSearch (object):
+    """
+    Base class for tree searches
+
+    After propose() and revert(), 'last_move' is a tuple (kind, nodes) where
+    'nodes' are the nodes whose children were changed by the move.
+
+    'moves' lists the moves (see perform_move) that lead from the tree given
+    to set_tree() (or the tree at the last reset()) to the current tree.
+    Proposals add a move and revert() removes it.
+    """
 
     def __init__(self, tree):
         self.tree = tree
+        self.last_move = None
+        self.moves = []
 
     def __iter__(self):
         return self
@@ -1727,21 +2491,31 @@ class TreeSearchNni (TreeSearch):
         self.node1 = None
         self.node2 = None
         self.child = None
+        self.last_move = None
+        del self.moves[:]
 
     def propose(self):
         self.node1, self.node2, self.child = propose_random_nni(self.tree)
+        self.moves.append(("nni", self.node1.name, self.node2.name,
+                           self.child))
         perform_nni(self.tree, self.node1, self.node2, self.child)
+        self.last_move = ("nni", [self.node1, self.node2])
         return self.tree
 
     def revert(self):
         if self.node1 is not None:
             perform_nni(self.tree, self.node1, self.node2, self.child)
+            self.last_move = ("nni", [self.node1, self.node2])
+            if self.moves:
+                self.moves.pop()
         return self.tree
 
     def reset(self):
         self.node1 = None
         self.node2 = None
         self.child = None
+        self.last_move = None
+        del self.moves[:]
 
 
 class TreeSearchSpr (TreeSearch):
@@ -1754,6 +2528,9 @@ class TreeSearchSpr (TreeSearch):
         self.tree = tree
         self.node1 = None
         self.node2 = None
+        self.changed = None
+        self.last_move = None
+        del self.moves[:]
 
     def propose(self):
 
@@ -1765,18 +2542,30 @@ class TreeSearchSpr (TreeSearch):
         self.node2 = (p.children[1] if p.children[0] == self.node1
                       else p.children[0])
 
+        # the old parent of the subtree, its parent, and the parent of the
+        # new position gain new children (the same nodes change on revert)
+        self.changed = [p.parent, p, node3.parent]
+
         # perform SPR move
+        self.moves.append(("spr", self.node1.name, node3.name))
         perform_spr(self.tree, self.node1, node3)
+        self.last_move = ("spr", self.changed)
         return self.tree
 
     def revert(self):
         if self.node1 is not None:
             perform_spr(self.tree, self.node1, self.node2)
+            self.last_move = ("spr", self.changed)
+            if self.moves:
+                self.moves.pop()
         return self.tree
 
     def reset(self):
         self.node1 = None
         self.node2 = None
+        self.changed = None
+        self.last_move = None
+        del self.moves[:]
 
 
 class TreeSearchMix (TreeSearch):
@@ -1790,6 +2579,8 @@ class TreeSearchMix (TreeSearch):
 
     def set_tree(self, tree):
         self.tree = tree
+        self.last_move = None
+        del self.moves[:]
         for method in self.methods:
             method[0].set_tree(tree)
 
@@ -1809,13 +2600,20 @@ class TreeSearchMix (TreeSearch):
         # make proposal
         self.last_propose = i
         self.tree = self.methods[i][0].propose()
+        self.last_move = self.methods[i][0].last_move
+        self.moves.append(self.methods[i][0].moves[-1])
         return self.tree
 
     def revert(self):
         self.tree = self.methods[self.last_propose][0].revert()
+        self.last_move = self.methods[self.last_propose][0].last_move
+        if self.moves:
+            self.moves.pop()
         return self.tree
 
     def reset(self):
+        self.last_move = None
+        del self.moves[:]
         for method in self.methods:
             method[0].reset()
 
@@ -1829,6 +2627,7 @@ class TreeSearchUnique (TreeSearch):
                  auto_add=True):
         TreeSearch.__init__(self, tree)
         self.search = search
+        self.moves = search.moves
         self.seen = set()
         self._tree_hash = tree_hash if tree_hash else hash_tree
         self.maxtries = maxtries
@@ -1882,19 +2681,25 @@ class TreeSearchPrescreen (TreeSearch):
         self.search = TreeSearchUnique(tree, search, auto_add=False)
         self.prescreen = prescreen
         self.poolsize = poolsize
-        self.oldtree = None
+        self.snapshot = None
+        self.nmoves = 0
         self.set_tree(tree)
 
 
     def set_tree(self, tree):
         self.tree = tree
+        self.snapshot = None
+        del self.moves[:]
         self.search.set_tree(tree)
 
 
     def propose(self):
 
         # save old topology
-        self.oldtree = self.tree.copy()
+        if self.tree.journal is None:
+            self.tree.start_journal()
+        self.snapshot = self.tree.snapshot()
+        self.nmoves = len(self.moves)
 
         pool = []
         best_score = self.prescreen(self.tree)
@@ -1907,10 +2712,9 @@ class TreeSearchPrescreen (TreeSearch):
         for i in xrange(self.poolsize):
             self.search.propose()
             score = self.prescreen(self.tree)
-            tree = self.tree.copy()
 
-            # save tree and logl
-            pool.append((tree, score))
+            # save moves to tree and logl
+            pool.append((tuple(self.search.moves), score))
             total = stats.logadd(total, score)
 
             if score > best_score:
@@ -1923,24 +2727,30 @@ class TreeSearchPrescreen (TreeSearch):
         choice = random.random()
         partsum = -util.INF
 
-        for tree, score in pool:
+        chosen = tuple(self.search.moves)
+        for moves, score in pool:
             partsum = stats.logadd(partsum, score)
             if choice < math.exp(partsum - total):
                 # propose tree i
-                treelib.set_tree_topology(self.tree, tree)
+                self.tree.restore(self.snapshot)
+                for move in moves:
+                    perform_move(self.tree, move)
+                chosen = moves
                 break
-
+        self.moves.extend(chosen)
 
         self.search.add_seen(self.tree)
 
 
     def revert(self):
-        if self.oldtree:
-            treelib.set_tree_topology(self.tree, self.oldtree)
+        if self.snapshot is not None:
+            self.tree.restore(self.snapshot)
+            del self.moves[self.nmoves:]
 
 
     def reset(self):
-        self.oldtree = None
+        self.snapshot = None
+        del self.moves[:]
         self.search.reset()
 
 
@@ -2226,19 +3036,16 @@ def find_splits(tree, rooted=False):
     all_leaves = set(tree.leaf_names())
     nall_leaves = len(all_leaves)
 
-    # find descendants
+    # find descendants (children follow their parents in preorder)
     descendants = {}
-    def walk(node):
+    for node in reversed(tree.root.descendants()):
         if node.is_leaf():
-            s = descendants[node] = set([node.name])
+            descendants[node] = set([node.name])
         else:
             s = set()
             for child in node.children:
-                s.update(walk(child))
+                s.update(descendants[child])
             descendants[node] = s
-        return s
-    for child in tree.root.children:
-        walk(child)
 
     # left child's descendants immediately defines
     # right child's descendants (by complement)
@@ -2357,18 +3164,63 @@ def _consensus_special(trees, rooted=False):
     return None
 
 
-def add_bootstraps(tree, trees, rooted=False):
+# trees per worker task in add_bootstraps
+SPLIT_CHUNK_SIZE = 1000
+
+
+def count_splits(trees, rooted=False):
     """
-    Add bootstrap support to tree
+    Returns the number of trees and a list of the splits with the number
+    of trees having them (in order of first appearance)
     """
-
-    # get bootstrap counts
     ntrees = 0
-    split_counts = util.Dict(dim=1, default=0)
+    split_counts = {}
+    splits = []
     for gtree in trees:
         ntrees += 1
         for split in find_splits(gtree, rooted=rooted):
-            split_counts[split] += 1
+            if split in split_counts:
+                split_counts[split] += 1
+            else:
+                split_counts[split] = 1
+                splits.append(split)
+    return ntrees, [(split, split_counts[split]) for split in splits]
+
+
+def _count_splits_worker(args):
+    """count_splits for a worker process"""
+    trees, rooted = args
+    try:
+        return count_splits(trees, rooted)
+    finally:
+        trees.close()
+
+
+def add_bootstraps(tree, trees, rooted=False, pool=None):
+    """
+    Add bootstrap support to tree
+
+    pool -- optional multiprocessing pool that counts the splits of ranges
+            of the trees if trees is a treelib.TreeFile
+    """
+
+    # get bootstrap counts
+    if pool is not None and isinstance(trees, treelib.TreeFile) and \
+       len(trees) > SPLIT_CHUNK_SIZE:
+        tasks = [(trees[i:i+SPLIT_CHUNK_SIZE], rooted)
+                 for i in xrange(0, len(trees), SPLIT_CHUNK_SIZE)]
+        chunks = pool.map(_count_splits_worker, tasks)
+    else:
+        chunks = [count_splits(trees, rooted)]
+
+    # splits are added in order of first appearance so that the counts
+    # below are visited in the same order however the trees were split
+    ntrees = 0
+    split_counts = {}
+    for n, chunk_counts in chunks:
+        ntrees += n
+        for split, count in chunk_counts:
+            split_counts[split] = split_counts.get(split, 0) + count
 
     counts = {}
     for split, count in split_counts.iteritems():
@@ -2376,17 +3228,17 @@ def add_bootstraps(tree, trees, rooted=False):
         counts[split[1]] = count
 
     # add bootstrap support to tree
-    def walk(node):
+    # (children follow their parents in preorder)
+    leaf_sets = {}
+    for node in reversed(tree.root.descendants()):
         if node.is_leaf():
             s = set([node.name])
         else:
             s = set()
             for child in node.children:
-                s.update(walk(child))
+                s.update(leaf_sets.pop(child))
             node.data["boot"] = counts.get(tuple(sorted(s)),0)/float(ntrees)
-        return s
-    for child in tree.root.children:
-        walk(child)
+        leaf_sets[node] = s
 
     if rooted:
         if tree.root.children[0].is_leaf() or \
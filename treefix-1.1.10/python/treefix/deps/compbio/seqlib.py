@@ -116,6 +116,10 @@ class SeqDict (dict):
     def __len__(self):
         return len(self.names)
 
+    def __reduce__(self):
+        # pickle items in order (needed to send alignments to other processes)
+        return (type(self), (), self.__dict__, None, self.iteritems())
+
 
 
 #--------------------------------------------------------------------------------
@@ -17,7 +17,11 @@
 ########################################################################
 
 # python libs
+import array
 import copy
+import gc
+import mmap
+import re
 import sys
 import StringIO
 
@@ -59,6 +63,7 @@ except ImportError:
 #       data:       Dictionary{???:???} // KV map from who knows what to whatever else
 #                                       // This behavior is actually defined by Branch Data
 #                                       // By default, String: String mapping.
+#                                       // Created on first access (slot _data is None until then)
 #
 #   methods:
 #       __iter__: means is iterable over its own children.  reference https://wiki.python.org/moin/Iterator
@@ -76,14 +81,42 @@ class TreeNode (object):
     """A class for nodes in a rooted Tree
 
     Contains fields for branch length 'dist' and custom data 'data'
+
+    The fields are slots and the data dict is only created when 'data' is
+    first used, so nodes without data stay small.  Other attributes can
+    still be set on nodes.
     """
 
+    __slots__ = ("name", "children", "parent", "dist", "_data", "__dict__")
+
     def __init__(self, name=None):
         self.name = name
         self.children = []
         self.parent = None
         self.dist = 0
-        self.data = {}
+        self._data = None
+
+    def _get_data(self):
+        data = self._data
+        if data is None:
+            data = self._data = {}
+        return data
+
+    def _set_data(self, data):
+        self._data = data
+
+    data = property(_get_data, _set_data,
+                    doc="custom data of the node (created on first use)")
+
+    def __getstate__(self):
+        state = dict(getattr(self, "__dict__", ()))
+        state.update(name=self.name, children=self.children,
+                     parent=self.parent, dist=self.dist, _data=self._data)
+        return state
+
+    def __setstate__(self, state):
+        for key, val in state.iteritems():
+            setattr(self, key, val)
 
     def __iter__(self):
         """Iterate through child nodes"""
@@ -92,17 +125,32 @@ class TreeNode (object):
     def copy(self, parent=None, copyChildren=True, copyData=True):
         """Returns a copy of a TreeNode and all of its children"""
 
-        node = TreeNode(self.name)
-        node.name = self.name
-        node.dist = self.dist
-        node.parent = parent
-        if copyData:
-            node.data = copy.copy(self.data)
-        if copyChildren:
-            for child in self.children:
-                node.children.append(child.copy(node, copyData=copyData))
-
-        return node
+        root = TreeNode(self.name)
+        root.dist = self.dist
+        root.parent = parent
+        if copyData and self._data:
+            root._data = copy.copy(self._data)
+
+        # copy the subtree with an explicit stack of originals and copies
+        if copyChildren and self.children:
+            stack = [self, root]
+            pop = stack.pop
+            push = stack.append
+            while stack:
+                node = pop()
+                children = node.children
+                for child in pop().children:
+                    child2 = TreeNode(child.name)
+                    child2.dist = child.dist
+                    child2.parent = node
+                    if copyData and child._data:
+                        child2._data = copy.copy(child._data)
+                    children.append(child2)
+                    if child.children:
+                        push(child)
+                        push(child2)
+
+        return root
 
     def is_leaf(self):
         """Returns True if the node is a leaf (no children)"""
@@ -117,12 +165,15 @@ class TreeNode (object):
         """Returns the leaves beneath the node in traversal order"""
         leaves = []
 
-        def walk(node):
-            if node.is_leaf():
+        stack = [self]
+        pop = stack.pop
+        extend = stack.extend
+        while stack:
+            node = pop()
+            if node.children:
+                extend(node.children[::-1])
+            else:
                 leaves.append(node)
-            for child in node.children:
-                walk(child)
-        walk(self)
 
         return leaves
 
@@ -134,11 +185,10 @@ class TreeNode (object):
         """Returns the ancestors above the node in traversal order"""
         ancestors = []
 
-        def walk(node):
-            if node.parent:
-                ancestors.append(node.parent)
-                walk(node.parent)
-        walk(self)
+        node = self.parent
+        while node:
+            ancestors.append(node)
+            node = node.parent
 
         return ancestors
 
@@ -150,11 +200,13 @@ class TreeNode (object):
         """Returns the descendants beneath the node in traversal order"""
         descendants = []
 
-        def walk(node):
-            for child in node.children:
-                descendants.append(child)
-                walk(child)
-        walk(self)
+        stack = self.children[::-1]
+        pop = stack.pop
+        extend = stack.extend
+        while stack:
+            node = pop()
+            descendants.append(node)
+            extend(node.children[::-1])
 
         return descendants
 
@@ -205,8 +257,8 @@ class BranchData (object):
 
     def get_branch_data(self, node):
         """Returns branch specific data from a node"""
-        if "boot" in node.data:
-            return {"boot": node.data["boot"]}
+        if node._data and "boot" in node._data:
+            return {"boot": node._data["boot"]}
         else:
             return {}
 
@@ -217,8 +269,9 @@ class BranchData (object):
 
     def split_branch_data(self, node):
         """Split a branch's data into two copies"""
-        if "boot" in node.data:
-            return {"boot": node.data["boot"]}, {"boot": node.data["boot"]}
+        if node._data and "boot" in node._data:
+            boot = node._data["boot"]
+            return {"boot": boot}, {"boot": boot}
         else:
             return {}, {}
 
@@ -242,6 +295,7 @@ class BranchData (object):
 #       data:           Dictionary{???:???}         // again,   "     ->"
 #       branch_data:    BranchData
 #       name:           String
+#       journal:        List or None                // undo journal (see start_journal)
 #
 #   methods:
 #       __repr__:  toString method
@@ -278,6 +332,11 @@ class BranchData (object):
 #
 #       clear: delete tree
 #
+#      journal functions:
+#       start_journal, stop_journal: record in-place changes (nni, spr, reroot, ...)
+#       snapshot: mark the current state in the journal
+#       restore: undo the changes recorded since a snapshot
+#
 #      data functions:
 #       has_data: looks for dataname in default_data set
 #       copy_data: puts data from this tree into another tree
@@ -305,6 +364,7 @@ class Tree (object):
         self.data = {}
         self.branch_data = branch_data
         self.name = name
+        self.journal = None
 
     def __repr__(self):
         """Returns a representation of the tree"""
@@ -321,11 +381,9 @@ class Tree (object):
             tree.root = self.root.copy(copyData=copyData)
 
             # set all names
-            def walk(node):
+            tree.nodes[tree.root.name] = tree.root
+            for node in tree.root.descendants():
                 tree.nodes[node.name] = node
-                for child in node.children:
-                    walk(child)
-            walk(tree.root)
 
         # copy extra data
         if copyData:
@@ -485,12 +543,9 @@ class Tree (object):
         Updates node.parent to None.
         """
 
-        def walk(node):
-            if node.name in self.nodes:
-                del self.nodes[node.name]
-            for child in node.children:
-                walk(child)
-        walk(node)
+        for node2 in self.preorder(node):
+            if node2.name in self.nodes:
+                del self.nodes[node2.name]
 
         if node.parent:
             node.parent.children.remove(node)
@@ -501,6 +556,8 @@ class Tree (object):
         if oldname != newname:
             assert newname not in self.nodes, newname
             node = self.nodes[oldname]
+            self.record_tree([oldname, newname])
+            self.record(node)
             del self.nodes[oldname]
             self.nodes[newname] = node
             node.name = newname
@@ -583,6 +640,66 @@ class Tree (object):
         """Returns the descendant names in order"""
         return node.descendant_names()
 
+    #===============================
+    # undo journal
+    #
+    # While a journal is kept, the functions that change the tree in place
+    # (rename, unroot, reroot, phylo.perform_nni, phylo.perform_spr) record
+    # the old state of the nodes they change, so that the tree can be
+    # returned to a snapshot without copying it.
+
+    def start_journal(self):
+        """Starts recording changes to the tree (discards any old journal)"""
+        self.journal = []
+
+    def stop_journal(self):
+        """Stops recording changes to the tree"""
+        self.journal = None
+
+    def snapshot(self):
+        """Returns a snapshot of the current tree for restore()"""
+        assert self.journal is not None, "tree has no journal"
+        return len(self.journal)
+
+    def restore(self, snapshot):
+        """Undoes all changes recorded since a snapshot"""
+        journal = self.journal
+        while len(journal) > snapshot:
+            entry = journal.pop()
+            node = entry[0]
+            if node is None:
+                # tree state
+                self.root, self.nextname, names = entry[1:]
+                for name, node in names:
+                    if node is None:
+                        self.nodes.pop(name, None)
+                    else:
+                        self.nodes[name] = node
+            else:
+                # node state
+                node.name, node.parent, node.children, node.dist, \
+                    node._data = entry[1:]
+
+    def record(self, *nodes):
+        """Records the state of nodes before they are changed"""
+        journal = self.journal
+        if journal is not None:
+            for node in nodes:
+                journal.append((node, node.name, node.parent,
+                                node.children[:], node.dist,
+                                copy.copy(node._data) if node._data
+                                else None))
+
+    def record_tree(self, names=()):
+        """
+        Records the root, next name, and the nodes of the given names
+        (None for unused names) before they are changed
+        """
+        if self.journal is not None:
+            self.journal.append((None, self.root, self.nextname,
+                                 [(name, self.nodes.get(name))
+                                  for name in names]))
+
     #===============================
     # data functions
 
@@ -600,7 +717,8 @@ class Tree (object):
         """Copy node data to another tree"""
         for name, node in self.nodes.iteritems():
             if name in tree.nodes:
-                node.data = copy.copy(tree.nodes[name].data)
+                data = tree.nodes[name]._data
+                node._data = copy.copy(data) if data else None
         self.set_default_data()
 
     def set_default_data(self):
@@ -613,11 +731,11 @@ class Tree (object):
         """Clear tree data"""
         for node in self.nodes.itervalues():
             if len(keys) == 0:
-                node.data = {}
-            else:
+                node._data = None
+            elif node._data:
                 for key in keys:
-                    if key in node.data:
-                        del node.data[key]
+                    if key in node._data:
+                        del node._data[key]
 
     #======================================================================
     # branch data functions
@@ -677,13 +795,13 @@ class Tree (object):
         """Default data writer: writes optional bootstrap and branch length"""
 
         string = ""
-        if "boot" in node.data and \
+        if node._data and "boot" in node._data and \
            not node.is_leaf() and \
            self.root != node:
-            if isinstance(node.data["boot"], int):
-                string += "%d" % node.data["boot"]
+            if isinstance(node._data["boot"], int):
+                string += "%d" % node._data["boot"]
             else:
-                string += "%f" % node.data["boot"]
+                string += "%f" % node._data["boot"]
         else:
             # see if internal node names exist
             if not node.is_leaf() and isinstance(node.name, str):
@@ -723,6 +841,17 @@ class Tree (object):
 #============================================================================
 # Input/Output functions
 
+# newick streams are read in chunks of this size
+NEWICK_CHUNK_SIZE = 1 << 16
+
+# newick tokens: special characters, comments (possibly unterminated), and
+# words (white space between tokens is skipped)
+NEWICK_TOKEN = re.compile(r"[;(),:\]]|\[[^\]]*\]?|[^ \t\n;(),:\[\]]+")
+
+# characters that start a comment or end a tree
+NEWICK_END = re.compile(r"[\[;]")
+
+
 def read_tree(infile, read_data=None, tree=None, namefunc=lambda name: name):
     """Read a tree from a file stream"""
     infile = util.open_stream(infile)
@@ -741,72 +870,218 @@ def iter_trees(treefile, read_data=None, namefunc=lambda name: name):
     """read multiple trees from a tree file"""
 
     infile = util.open_stream(treefile)
+    texts = iter_newick_texts(infile)
 
     # ensure at least one tree in file
-    yield read_tree(infile, read_data=read_data, namefunc=namefunc)
-    try:
-        while True:
-            yield read_tree(infile, read_data=read_data, namefunc=namefunc)
-    except Exception:
-        pass
+    yield parse_newick(next(texts, ""), read_data=read_data, namefunc=namefunc)
+    for text in texts:
+        yield parse_newick(text, read_data=read_data, namefunc=namefunc)
 
 
 def read_trees(filename, read_data=None, namefunc=lambda name: name):
-    return list(iter_trees(filename, read_data=read_data, namefunc=namefunc))
+    """read all trees from a tree file"""
+
+    # the cyclic garbage collector would rescan all nodes read so far
+    # (nodes and parents form cycles)
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return list(iter_trees(filename, read_data=read_data,
+                               namefunc=namefunc))
+    finally:
+        if enabled:
+            gc.enable()
 
 
-def tokenize_newick(infile):
+def split_newick(read, text=""):
     """
-    Iterates through the tokens in a stream in newick format
+    Returns the text of the next tree in a newick stream (up to and
+    including its ';', or to the end of the stream) and the text read
+    past it
 
-    infile -- a string or file stream
+    read -- a function returning the next chunk of the stream ("" at EOF)
+    text -- text already read from the stream
     """
 
-    def iter_stream(infile):
-        while True:
-            yield infile.read(1)
+    pieces = []
+    pos = 0
+    incomment = False
+    while True:
+        if incomment:
+            end = text.find("]", pos)
+            if end != -1:
+                pos = end + 1
+                incomment = False
+                continue
+        else:
+            match = NEWICK_END.search(text, pos)
+            if match is not None:
+                pos = match.end()
+                if match.group() == ";":
+                    pieces.append(text[:pos])
+                    return "".join(pieces), text[pos:]
+                incomment = True
+                continue
+
+        # read more of the stream
+        pieces.append(text)
+        text = read()
+        pos = 0
+        if not text:
+            return "".join(pieces), ""
+
+
+def iter_newick_texts(infile, chunksize=NEWICK_CHUNK_SIZE):
+    """
+    Iterates through the text of each tree in a newick stream
+    (white space after the last tree is not a tree)
+    """
+    read = lambda: infile.read(chunksize)
+    rest = ""
+    while True:
+        text, rest = split_newick(read, rest)
+        if not text.strip():
+            break
+        yield text
 
-    if not isinstance(infile, basestring):
-        infile = iter_stream(infile)
-    else:
-        infile = iter(infile)
 
-    word = []
-    for c in infile:
-        if c == "":
-            # EOF encountered
-            break
+def read_newick_text(infile):
+    """
+    Returns the text of the next tree in a newick stream
 
-        elif c in " \t\n":
-            # skip white space
-            if word:
-                yield "".join(word)
-                word[:] = []
-
-        elif c in ";(),:[]":
-            # special tokens
-            if word:
-                yield "".join(word)
-                word[:] = []
-
-            if c == "[":
-                # parse comment
-                word.append(c)
-                for c in infile:
-                    word.append(c)
-                    if c == "]":
-                        break
-                yield "".join(word)
-                word[:] = []
-            else:
-                yield c
+    The stream is read in chunks and left just after the tree.  Streams
+    that cannot seek back over the text read past the tree are read one
+    character at a time.
+    """
+    try:
+        infile.tell()
+    except (AttributeError, IOError):
+        return split_newick(lambda: infile.read(1))[0]
+
+    text, rest = split_newick(lambda: infile.read(NEWICK_CHUNK_SIZE))
+    if rest:
+        infile.seek(-len(rest), 1)
+    return text
+
+
+def index_trees(text):
+    """
+    Returns arrays of the start and end offsets of the trees in newick
+    text (a string or mmap), where each tree ends with its ';' or the end
+    of the text (white space after the last tree is not a tree)
+    """
+    starts = array.array("l")
+    ends = array.array("l")
+    start = pos = 0
+    while True:
+        match = NEWICK_END.search(text, pos)
+        if match is None:
+            break
+        elif match.group() == ";":
+            pos = match.end()
+            starts.append(start)
+            ends.append(pos)
+            start = pos
         else:
-            # word token
-            word.append(c)
+            # skip comment
+            pos = text.find("]", match.end()) + 1
+            if pos == 0:
+                break
+
+    if text[start:].strip():
+        starts.append(start)
+        ends.append(len(text))
+    return starts, ends
+
+
+class TreeFile (object):
+    """
+    Random access to the trees of a newick file
+
+    The offsets of the trees are found in one pass over the file (see
+    index_trees) and tree i is parsed directly from a memory map of the
+    file.  Slices are TreeFiles of a range of the trees, which are pickled
+    as the file name and offsets (e.g. to send to worker processes).
+    """
+
+    def __init__(self, filename, offsets=None):
+        """
+        offsets -- optional start and end offsets of the trees
+                   (from index_trees)
+        """
+        self.filename = filename
+        self._file = None
+        self._text = None
+        if offsets is None:
+            offsets = index_trees(self.get_file_text())
+        self.starts, self.ends = offsets
+
+    def get_file_text(self):
+        """Returns the text of the file (memory mapped)"""
+        if self._text is None:
+            self._file = open(self.filename, "rb")
+            try:
+                self._text = mmap.mmap(self._file.fileno(), 0,
+                                       access=mmap.ACCESS_READ)
+            except ValueError:
+                # empty files cannot be mapped
+                self._text = ""
+        return self._text
+
+    def close(self):
+        """Closes the file"""
+        if self._file is not None:
+            if isinstance(self._text, mmap.mmap):
+                self._text.close()
+            self._file.close()
+            self._file = None
+            self._text = None
+
+    def get_text(self, i):
+        """Returns the text of tree i"""
+        return self.get_file_text()[self.starts[i]:self.ends[i]]
+
+    def get_tree(self, i, read_data=None, namefunc=lambda name: name):
+        """Returns tree i"""
+        return parse_newick(self.get_text(i), read_data=read_data,
+                            namefunc=namefunc)
+
+    def __len__(self):
+        return len(self.starts)
 
-    if word:
-        yield "".join(word)
-        word[:] = []
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return TreeFile(self.filename, (self.starts[i], self.ends[i]))
+        return self.get_tree(i)
+
+    def __iter__(self):
+        for i in xrange(len(self.starts)):
+            yield self.get_tree(i)
+
+    def __getstate__(self):
+        return {"filename": self.filename,
+                "starts": self.starts,
+                "ends": self.ends}
+
+    def __setstate__(self, state):
+        self.__init__(state["filename"], (state["starts"], state["ends"]))
+
+
+def tokenize_newick(infile):
+    """
+    Iterates through the tokens in a stream in newick format
+
+    infile -- a string or file stream
+    """
+
+    if isinstance(infile, basestring):
+        texts = [infile]
+    else:
+        texts = iter_newick_texts(infile)
+
+    for text in texts:
+        for match in NEWICK_TOKEN.finditer(text):
+            yield match.group()
 
 
 def parse_newick(infile, read_data=None, tree=None,
@@ -834,68 +1109,63 @@ def parse_newick(infile, read_data=None, tree=None,
     tree.root = node
     nodes = [node]
 
-    # process token stream
-    tokens = tokenize_newick(infile)
+    # process tokens of the first tree
+    if isinstance(infile, basestring):
+        text = split_newick(lambda: "", infile)[0]
+    else:
+        text = read_newick_text(infile)
+    tokens = NEWICK_TOKEN.findall(text)
+    if not tokens:
+        raise Exception("Empty tree")
+
     token = None
     data = []
-    empty = True
-    try:
-        while True:
-            prev_token = token
-            token = tokens.next()
-            empty = False
-
-            if token == '(':  # new branchset
-                if data:
-                    read_data(node, "".join(data), namefunc)
-                    data = []
-                child = TreeNode()
-                nodes.append(child)
-                child.parent = node
-                node.children.append(child)
-                ancestors.append(node)
-                node = child
-
-            elif token == ',':  # another branch
-                if data:
-                    read_data(node, "".join(data), namefunc)
-                    data = []
-                parent = ancestors[-1]
-                child = TreeNode()
-                nodes.append(child)
-
-                child.parent = parent
-                parent.children.append(child)
-                node = child
-
-            elif token == ')':  # optional name next
-                if data:
-                    read_data(node, "".join(data), namefunc)
-                    data = []
-                node = ancestors.pop()
-
-            elif token == ':':  # optional length next
-                data.append(token)
+    for token2 in tokens:
+        prev_token, token = token, token2
 
-            elif token == ';':  # end of tree
-                if data:
-                    read_data(node, "".join(data), namefunc)
-                    data = []
-                break
+        if token == '(':  # new branchset
+            if data:
+                read_data(node, "".join(data), namefunc)
+                data = []
+            child = TreeNode()
+            nodes.append(child)
+            child.parent = node
+            node.children.append(child)
+            ancestors.append(node)
+            node = child
+
+        elif token == ',':  # another branch
+            if data:
+                read_data(node, "".join(data), namefunc)
+                data = []
+            parent = ancestors[-1]
+            child = TreeNode()
+            nodes.append(child)
 
-            else:
-                if prev_token in '(,':
-                    node.name = namefunc(token)
+            child.parent = parent
+            parent.children.append(child)
+            node = child
 
-                elif prev_token in '):':
-                    data.append(token)
+        elif token == ')':  # optional name next
+            if data:
+                read_data(node, "".join(data), namefunc)
+                data = []
+            node = ancestors.pop()
 
-                else:
-                    data.append(token)
+        elif token == ':':  # optional length next
+            data.append(token)
+
+        elif token == ';':  # end of tree
+            if data:
+                read_data(node, "".join(data), namefunc)
+                data = []
+            break
 
-    except StopIteration:
-        if empty:
-            raise Exception("Empty tree")
+        else:
+            if prev_token in '(,':
+                node.name = namefunc(token)
+            else:
+                data.append(token)
 
     # setup node names
     names = set()
@@ -907,7 +1177,7 @@ def parse_newick(infile, read_data=None, tree=None,
 
     # test for bootstrap presence
     for node in nodes:
-        if "boot" in node.data:
+        if node._data and "boot" in node._data:
             tree.default_data["boot"] = 0
             break
     tree.set_default_data()
@@ -933,44 +1203,54 @@ def write_newick_node(tree, node, out=sys.stdout,
         writeDist = any(node.dist != 0 for node in tree)
         write_data = lambda node: tree.write_data(node, writeDist=writeDist, namefunc=namefunc)
 
-    if not oneline:
-        out.write(" " * depth)
+    # stack of (node, depth, opening); a node of None writes a separator
+    stack = [(node, depth, True)]
+    while stack:
+        node, depth, opening = stack.pop()
 
-    if len(node.children) == 0:
-        # leaf
-        out.write(str(namefunc(node.name)))
-    else:
-        # internal node
-        if oneline:
-            out.write("(")
-        else:
-            out.write("(\n")
-        for child in node.children[:-1]:
-            write_newick_node(tree, child, out, depth+1,
-                              write_data=write_data, oneline=oneline,
-                              namefunc=namefunc)
+        if node is None:
             if oneline:
                 out.write(",")
             else:
                 out.write(",\n")
-        write_newick_node(tree, node.children[-1], out, depth+1,
-                          write_data=write_data, oneline=oneline,
-                          namefunc=namefunc)
-        if oneline:
-            out.write(")")
+            continue
+
+        if opening:
+            if not oneline:
+                out.write(" " * depth)
+
+            if len(node.children) == 0:
+                # leaf
+                out.write(str(namefunc(node.name)))
+            else:
+                # internal node: write children, then close it
+                if oneline:
+                    out.write("(")
+                else:
+                    out.write("(\n")
+                stack.append((node, depth, False))
+                children = node.children
+                stack.append((children[-1], depth+1, True))
+                for i in xrange(len(children) - 2, -1, -1):
+                    stack.append((None, depth+1, False))
+                    stack.append((children[i], depth+1, True))
+                continue
         else:
-            out.write("\n" + (" " * depth) + ")")
+            if oneline:
+                out.write(")")
+            else:
+                out.write("\n" + (" " * depth) + ")")
 
-    # don't print data for root node
-    if depth == 0:
-        if root_data:
-            out.write(write_data(node))
-        if oneline:
-            out.write(";")
+        # don't print data for root node
+        if depth == 0:
+            if root_data:
+                out.write(write_data(node))
+            if oneline:
+                out.write(";")
+            else:
+                out.write(";\n")
         else:
-            out.write(";\n")
-    else:
-        out.write(write_data(node))
+            out.write(write_data(node))
 
 
 #=============================================================================
@@ -1024,7 +1304,7 @@ def read_newick_ply(filename, readData=None, tree=None):
 
     # test for bootstrap presence
     for node in tree.nodes.itervalues():
-        if "boot" in node.data:
+        if node._data and "boot" in node._data:
             tree.default_data["boot"] = 0
             break
     tree.set_default_data()
@@ -1283,8 +1563,8 @@ def read_nhx_data(node, text):
 def write_nhx_data(node):
     """Write data function for writing the data field of an NHX file"""
     text = Tree().write_data(node)
-    if node.data:
-        text += format_nhx_comment(node.data)
+    if node._data:
+        text += format_nhx_comment(node._data)
     return text
 
 
@@ -1296,7 +1576,7 @@ def assert_tree(tree):
 
     visited = set()
 
-    def walk(node):
+    for node in tree.preorder():
         assert node.name in tree.nodes, (tree.name, node.name)
         assert node.name not in visited, (tree.name, node.name)
         visited.add(node.name)
@@ -1304,8 +1584,6 @@ def assert_tree(tree):
             assert node in node.parent.children, (tree.name, node.name)
         for child in node.children:
             assert child.parent == node, (tree.name, node.name, child.name)
-        node.recurse(walk)
-    walk(tree.root)
     assert tree.root.parent is None, (tree.name, tree.root.name)
     assert len(tree.nodes) == len(visited), (
         "%d %d" % (len(tree.nodes), len(visited)))
@@ -1329,8 +1607,15 @@ def is_binary(tree):
     return True
 
 
-def lca(nodes):
-    """Returns the Least Common Ancestor (LCA) of a list of nodes"""
+def lca(nodes, lca_index=None):
+    """
+    Returns the Least Common Ancestor (LCA) of a list of nodes
+
+    lca_index -- optional LCAIndex of the tree for constant-time queries
+    """
+
+    if lca_index is not None:
+        return lca_index.lca(nodes)
 
     if len(nodes) == 1:
         return nodes[0]
@@ -1357,6 +1642,100 @@ def lca(nodes):
         raise Exception("No nodes given")
 
 
+class LCAIndex (object):
+    """
+    Index of a tree for constant-time Least Common Ancestor (LCA) queries
+
+    The Euler tour of the tree is stored with the depth of each visit.
+    The LCA of two nodes is the shallowest visit between their first
+    visits, which is found with a sparse table of range minima.  The
+    index must be rebuilt if the tree changes.
+    """
+
+    def __init__(self, tree):
+        self.tree = tree
+        self.depths = {}        # node -> depth (root has depth 0)
+        self.first = {}         # node -> index of first visit in tour
+        self.tour = []          # nodes in Euler tour order
+        self.tour_depths = []   # depth of each visit in tour
+
+        # Euler tour (each node is visited before and after each child)
+        tour, tour_depths = self.tour, self.tour_depths
+        self.depths[tree.root] = 0
+        stack = [[tree.root, 0]]
+        while stack:
+            top = stack[-1]
+            node, i = top
+            if i == 0:
+                self.first[node] = len(tour)
+            tour.append(node)
+            tour_depths.append(len(stack) - 1)
+            if i < len(node.children):
+                child = node.children[i]
+                top[1] += 1
+                self.depths[child] = len(stack)
+                stack.append([child, 0])
+            else:
+                stack.pop()
+
+        # sparse table: sparse[k][i] is the index of the shallowest visit
+        # in tour[i:i+2**k]
+        row = range(len(tour))
+        self.sparse = [row]
+        width = 1
+        while 2 * width <= len(tour):
+            prev = row
+            row = []
+            for i in xrange(len(tour) - 2 * width + 1):
+                a = prev[i]
+                b = prev[i + width]
+                row.append(a if tour_depths[a] <= tour_depths[b] else b)
+            self.sparse.append(row)
+            width *= 2
+
+    def lca_pair(self, node1, node2):
+        """Returns the LCA of two nodes"""
+        i = self.first[node1]
+        j = self.first[node2]
+        if i > j:
+            i, j = j, i
+        k = (j - i + 1).bit_length() - 1
+        row = self.sparse[k]
+        a = row[i]
+        b = row[j - (1 << k) + 1]
+        if self.tour_depths[a] <= self.tour_depths[b]:
+            return self.tour[a]
+        else:
+            return self.tour[b]
+
+    def lca(self, nodes):
+        """Returns the LCA of a list of nodes"""
+        if len(nodes) == 1:
+            return nodes[0]
+        elif len(nodes) == 2:
+            return self.lca_pair(nodes[0], nodes[1])
+        elif len(nodes) > 2:
+            # the LCA of the nodes visited first and last covers all nodes
+            first = self.first
+            firsts = [first[node] for node in nodes]
+            return self.lca_pair(self.tour[min(firsts)], self.tour[max(firsts)])
+        else:
+            raise Exception("No nodes given")
+
+    def relabel(self, labels):
+        """
+        Returns a copy of the index that answers queries on labels of nodes
+        (e.g. integer ids) given by the dict 'labels'
+        """
+        index = copy.copy(self)
+        index.depths = dict((labels[node], depth)
+                            for node, depth in self.depths.iteritems())
+        index.first = dict((labels[node], i)
+                           for node, i in self.first.iteritems())
+        index.tour = [labels[node] for node in self.tour]
+        return index
+
+
 def find_dist(tree, name1, name2):
     """Returns the branch distance between two nodes in a tree"""
 
@@ -1396,9 +1775,7 @@ def descendants(node, lst=None):
     """Return a list of all the descendants beneath a node"""
     if lst is None:
         lst = []
-    for child in node.children:
-        lst.append(child)
-        descendants(child, lst=lst)
+    lst.extend(node.descendants())
     return lst
 
 
@@ -1407,13 +1784,12 @@ def count_descendants(node, sizes=None):
     if sizes is None:
         sizes = {}
 
-    if len(node.children) > 0:
-        sizes[node] = 0
-        for child in node.children:
-            count_descendants(child, sizes)
-            sizes[node] += sizes[child]
-    else:
-        sizes[node] = 1
+    # children follow their parents in preorder
+    for node in reversed([node] + node.descendants()):
+        if len(node.children) > 0:
+            sizes[node] = sum(sizes[child] for child in node.children)
+        else:
+            sizes[node] = 1
 
     return sizes
 
@@ -1430,10 +1806,8 @@ def subtree(tree, node):
     tree2.root.parent = None
 
     # add nodes
-    def walk(node):
+    for node in tree2.preorder():
         tree2.add(node)
-        node.recurse(walk)
-    walk(tree2.root)
 
     return tree2
 
@@ -1456,13 +1830,11 @@ def max_disjoint_subtrees(tree, subroots):
     # subtrees are those trees with nodes that have at most one mark
     subroots2 = []
 
-    def walk(node):
+    for node in tree.preorder():
         marks.setdefault(node, [])
         if (len(marks[node]) < 2 and
                (not node.parent or len(marks[node.parent]) >= 2)):
             subroots2.append(node)
-        node.recurse(walk)
-    walk(tree.root)
 
     return subroots2
 
@@ -1568,14 +1940,10 @@ def remove_exposed_internal_nodes(tree, leaves=None):
                 stay.add(leaf)
 
     # post order traverse tree
-    def walk(node):
-        # keep a list of children to visit, since they may remove themselves
-        for child in list(node.children):
-            walk(child)
-
+    # (list the nodes first, since they may remove themselves)
+    for node in list(tree.postorder()):
         if node.is_leaf() and node not in stay:
             tree.remove(node)
-    walk(tree.root)
 
 
 def subtree_by_leaves(tree, leaves=None, keep_single=False,
@@ -1591,18 +1959,14 @@ def subtree_by_leaves(tree, leaves=None, keep_single=False,
 
     stay = set(leaves)
 
-    # post order traverse tree
-    def walk(node):
-        # keep a list of children to visit, since they may remove themselves
-        for child in list(node.children):
-            walk(child)
-
-        if node.is_leaf() and node not in stay:
-            tree.remove(node)
     if len(stay) == 0:
         tree.clear()
     else:
-        walk(tree.root)
+        # post order traverse tree
+        # (list the nodes first, since they may remove themselves)
+        for node in list(tree.postorder()):
+            if node.is_leaf() and node not in stay:
+                tree.remove(node)
 
     if not keep_single:
         remove_single_children(tree, simplify_root=simplify_root)
@@ -1627,24 +1991,20 @@ def reorder_tree(tree, tree2, root=True, leafmap=lambda leaf: leaf.name):
         root_branches = [set(map(leafmap, n.leaves()))
                          for n in tree2.root.children]
 
-        def walk(node):
+        leaf_sets = {}
+        for node in list(tree.postorder()):
             if node.is_leaf():
                 leaves = set([leafmap(node)])
             else:
                 leaves = set()
                 for child in node.children:
-                    l = walk(child)
-                    if l is None:
-                        return None
-                    leaves = leaves.union(l)
+                    leaves = leaves.union(leaf_sets.pop(child))
+            leaf_sets[node] = leaves
 
             if leaves in root_branches:
                 # root found, terminate search
                 reroot(tree, node.name, newCopy=False)
-                return None
-
-            return leaves
-        walk(tree.root)
+                break
 
     # reorder tree to match tree2
     leaf_lookup = util.list2lookup(map(leafmap, tree2.leaves()))
@@ -1652,26 +2012,22 @@ def reorder_tree(tree, tree2, root=True, leafmap=lambda leaf: leaf.name):
     def mean(lst):
         return sum(lst) / float(len(lst))
 
-    def walk2(node):
+    leaf_sets = {}
+    for node in list(tree.postorder()):
         if node.is_leaf():
-            return set([leafmap(node)])
+            leaf_sets[node] = set([leafmap(node)])
         else:
-            leaf_sets = []
+            child_sets = [leaf_sets.pop(child) for child in node.children]
 
-            for child in node.children:
-                leaf_sets.append(walk2(child))
-
-            scores = [mean(util.mget(leaf_lookup, l)) for l in leaf_sets]
+            scores = [mean(util.mget(leaf_lookup, l)) for l in child_sets]
             rank = util.sortindex(scores)
             node.children = util.mget(node.children, rank)
 
-            # return union
-            ret = leaf_sets[0]
-            for l in leaf_sets[1:]:
+            # union
+            ret = child_sets[0]
+            for l in child_sets[1:]:
                 ret = ret.union(l)
-            return ret
-
-    walk2(tree.root)
+            leaf_sets[node] = ret
 
 
 def set_tree_topology(tree, tree2):
@@ -1721,6 +2077,8 @@ def unroot(tree, newCopy=True):
 
     nodes = tree.root.children
     if len(nodes) == 2 and not (nodes[0].is_leaf() and nodes[1].is_leaf()):
+        tree.record_tree([tree.root.name])
+        tree.record(tree.root, nodes[0], nodes[1])
         dist = nodes[0].dist + nodes[1].dist
         data = tree.merge_branch_data(nodes[0].data, nodes[1].data)
         if len(nodes[0].children) < 2:
@@ -1764,12 +2122,19 @@ def reroot(tree, newroot, onBranch=True, newCopy=True, keepName=False):
     if not onBranch and tree.root.name == newroot:
         return tree
 
+    # record the nodes on the path to the root that are changed
+    if tree.journal is not None:
+        node1 = tree.nodes[newroot]
+        tree.record_tree()
+        tree.record(node1, *node1.ancestors())
+
     if onBranch:
         # add new root in middle of branch
         if keepName:
             newNode = TreeNode(oldroot)
         else:
             newNode = TreeNode(tree.new_name())
+        tree.record_tree([newNode.name])
         node1 = tree.nodes[newroot]
         rootdist = node1.dist
         rootdata1, rootdata2 = tree.split_branch_data(node1)
@@ -1820,6 +2185,126 @@ def reroot(tree, newroot, onBranch=True, newCopy=True, keepName=False):
     return tree
 
 
+class RerootCursor (object):
+    """
+    Walks the root of a rooted tree over all of its branches
+
+    The branches are visited in depth-first order from the branch of the
+    current root: first the subtree of root.children[0], then the subtree
+    of root.children[1].  Each step moves the root to a neighboring branch
+    (the branch above a grandchild of the root), which only changes the
+    children of the root and of one of its children, so each step takes
+    constant time.  The root node is kept, so node names do not change.
+    Internal branches are visited again when the walk returns from their
+    subtree ('revisit' is True for these steps).
+
+    Each rooting is the same as reroot(tree, name, keepName=True) would give,
+    including child order, distances, and branch data.
+    """
+
+    def __init__(self, tree):
+        assert len(tree.root.children) == 2, "tree must be rooted"
+        self.tree = tree
+        self.path = []          # (node, revisit) for each step
+        self.pos = 0
+        self.changed = None     # nodes changed by the last step (bottom-up)
+        self.revisit = False
+
+        # plan walk: each step moves the root above a node, which is the
+        # parent of the last branch when returning from its subtree
+        node1, node2 = tree.root.children
+        stack = [(child, node2, False) for child in reversed(node2.children)]
+        if node1.children:
+            stack.append((node1, node2, True))
+        stack.extend((child, node1, False) for child in reversed(node1.children))
+        path = self.path
+        while stack:
+            node, parent, leaving = stack.pop()
+            if leaving:
+                path.append((parent, True))
+            else:
+                path.append((node, False))
+                if node.children:
+                    stack.append((node, parent, True))
+                    stack.extend((child, node, False)
+                                 for child in reversed(node.children))
+
+    def __iter__(self):
+        return self
+
+    def __len__(self):
+        """Returns the number of steps of the walk"""
+        return len(self.path)
+
+    def next(self):
+        """Moves the root to the next branch and returns the changed nodes"""
+        if self.pos >= len(self.path):
+            raise StopIteration
+        node, self.revisit = self.path[self.pos]
+        self.pos += 1
+        return self.move(node)
+
+    def peek(self):
+        """
+        Returns the nodes that the next step will change (bottom-up),
+        or None at the end of the walk
+        """
+        if self.pos >= len(self.path):
+            return None
+        return (self.path[self.pos][0].parent, self.tree.root)
+
+    def move(self, node):
+        """
+        Moves the root to the branch above a grandchild of the root and
+        returns the nodes whose children changed (bottom-up)
+        """
+        tree = self.tree
+        root = tree.root
+        child = node.parent
+        nodes = root.children
+        assert child.parent is root and len(nodes) == 2
+        other = nodes[1] if nodes[0] is child else nodes[0]
+        tree.record(root, child, other, node)
+
+        # merge the branches of the root (as in unroot)
+        dist = child.dist + other.dist
+        data = tree.merge_branch_data(nodes[0].data, nodes[1].data)
+        child_top = (nodes[1] if len(nodes[0].children) < 2
+                     else nodes[0]) is child
+        if child_top:
+            other.dist = dist
+            tree.set_branch_data(other, data)
+            tree.set_branch_data(child, {})
+        else:
+            tree.set_branch_data(child, data)
+            tree.set_branch_data(other, {})
+
+        # split the branch above node for the root (as in reroot)
+        rootdata1, rootdata2 = tree.split_branch_data(node)
+        node.dist /= 2.0
+        tree.set_branch_data(node, rootdata1)
+        root.dist = 0
+        root._data = None
+        tree.set_branch_data(root, rootdata2)
+        olddata = tree.get_branch_data(child)
+        child.dist = node.dist
+        tree.set_branch_data(child, tree.get_branch_data(root))
+        if not child_top:
+            other.dist = dist
+            tree.set_branch_data(other, olddata)
+
+        # relink
+        child.children.remove(node)
+        child.children.append(other)
+        other.parent = child
+        nodes[0] = node
+        nodes[1] = child
+        node.parent = root
+
+        self.changed = (child, root)
+        return self.changed
+
+
 def midpoint_root(tree):
     """
     Reroot a tree using midpoint rerooting
@@ -2191,6 +2676,252 @@ def make_ptree(tree):
     return ptree, nodes, nodelookup
 
 
+#=============================================================================
+# compact trees
+
+class CompactTree (object):
+    """
+    Array-backed binary tree
+
+    Nodes are integer ids (the preorder of the original tree).  The parent,
+    left child, and right child of each node are kept in integer arrays
+    (-1 for none), so copies are cheap and local rearrangements only swap
+    integers.  Names, branch lengths, and data are kept so that conversion
+    to and from a Tree is lossless.  Copies share the names, dists, and
+    data lists, which rearrangements do not change.
+
+    species -- species id of each leaf (see compbio.phylo.compact_gene_tree)
+    """
+
+    def __init__(self, tree=None):
+        self.root = -1
+        self.parent = array.array("i")
+        self.left = array.array("i")
+        self.right = array.array("i")
+        self.names = []
+        self.dists = []
+        self.data = []
+        self.species = None
+
+        # tree attributes
+        self.name = None
+        self.nextname = 1
+        self.default_data = {}
+        self.tree_data = {}
+        self.branch_data = None
+
+        if tree is not None:
+            self.from_tree(tree)
+
+    def from_tree(self, tree):
+        """Sets the compact tree from a Tree"""
+        nodes = list(tree.preorder())
+        ids = dict((node, i) for i, node in enumerate(nodes))
+
+        n = len(nodes)
+        self.parent = array.array("i", [-1]) * n
+        self.left = array.array("i", [-1]) * n
+        self.right = array.array("i", [-1]) * n
+        for i, node in enumerate(nodes):
+            if len(node.children) > 2:
+                raise Exception("compact trees must be binary: node %s" %
+                                str(node.name))
+            if node.parent is not None:
+                self.parent[i] = ids[node.parent]
+            if len(node.children) > 0:
+                self.left[i] = ids[node.children[0]]
+            if len(node.children) > 1:
+                self.right[i] = ids[node.children[1]]
+        self.root = 0 if n > 0 else -1
+        self.names = [node.name for node in nodes]
+        self.dists = [node.dist for node in nodes]
+        self.data = [copy.copy(node._data) if node._data else None
+                     for node in nodes]
+        self.species = None
+
+        self.name = tree.name
+        self.nextname = tree.nextname
+        self.default_data = copy.copy(tree.default_data)
+        self.tree_data = copy.copy(tree.data)
+        self.branch_data = tree.branch_data
+
+    def to_tree(self):
+        """Returns the compact tree as a Tree"""
+        tree = Tree(nextname=self.nextname, name=self.name)
+        if self.branch_data is not None:
+            tree.branch_data = self.branch_data
+        tree.default_data = copy.copy(self.default_data)
+        tree.data = copy.copy(self.tree_data)
+
+        nodes = []
+        for i, name in enumerate(self.names):
+            node = TreeNode(name)
+            node.dist = self.dists[i]
+            node._data = copy.copy(self.data[i]) if self.data[i] else None
+            tree.nodes[name] = node
+            nodes.append(node)
+
+        for i in self.preorder():
+            node = nodes[i]
+            for child in (self.left[i], self.right[i]):
+                if child != -1:
+                    nodes[child].parent = node
+                    node.children.append(nodes[child])
+        if self.root != -1:
+            tree.root = nodes[self.root]
+
+        return tree
+
+    def copy(self):
+        """Returns a copy of the compact tree (sharing names, dists, and data)"""
+        tree = CompactTree()
+        tree.__dict__.update(self.__dict__)
+        tree.parent = self.parent[:]
+        tree.left = self.left[:]
+        tree.right = self.right[:]
+        return tree
+
+    def __len__(self):
+        """Returns number of nodes in tree"""
+        return len(self.names)
+
+    def is_leaf(self, node):
+        """Returns True if the node is a leaf (no children)"""
+        return self.left[node] == -1 and self.right[node] == -1
+
+    def children(self, node):
+        """Returns the children of a node"""
+        return [child for child in (self.left[node], self.right[node])
+                if child != -1]
+
+    def preorder(self, node=None):
+        """Returns the nodes in pre-order traversal"""
+        if node is None:
+            node = self.root
+        if node == -1:
+            return []
+        left, right = self.left, self.right
+        order = []
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            order.append(node)
+            if right[node] != -1:
+                stack.append(right[node])
+            if left[node] != -1:
+                stack.append(left[node])
+        return order
+
+    def postorder(self, node=None):
+        """Returns the nodes in post-order traversal"""
+        # reversing a (node, right, left) preorder gives (left, right, node)
+        if node is None:
+            node = self.root
+        if node == -1:
+            return []
+        left, right = self.left, self.right
+        order = []
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            order.append(node)
+            if left[node] != -1:
+                stack.append(left[node])
+            if right[node] != -1:
+                stack.append(right[node])
+        order.reverse()
+        return order
+
+    def leaves(self, node=None):
+        """Returns the leaves beneath the node in traversal order"""
+        return [x for x in self.preorder(node) if self.is_leaf(x)]
+
+    def leaf_names(self, node=None):
+        """Returns the leaf names beneath the node in traversal order"""
+        return [self.names[x] for x in self.leaves(node)]
+
+    def _get_child(self, node, i):
+        return self.left[node] if i == 0 else self.right[node]
+
+    def _set_child(self, node, i, child):
+        if i == 0:
+            self.left[node] = child
+        else:
+            self.right[node] = child
+
+    def perform_nni(self, node1, node2, change=0, rooted=True):
+        """
+        Performs a Nearest Neighbor Interchange on the branch (node1, node2)
+        (see compbio.phylo.perform_nni)
+        """
+        parent = self.parent
+        child = self._get_child
+
+        if parent[node1] != node2:
+            node1, node2 = node2, node1
+
+        # try to see if edge is one branch (not root edge)
+        if not rooted and node2 == self.root:
+            # special case of specifying root edge
+            if child(node2, 0) == node1:
+                node2 = child(node2, 1)
+            else:
+                node2 = child(node2, 0)
+
+            # edge is not an internal edge, give up
+            if len(self.children(node2)) < 2:
+                return
+
+        if parent[node1] == parent[node2] == self.root:
+            uncle = 0
+
+            if len(self.children(child(node2, 0))) < 2 and \
+               len(self.children(child(node2, 1))) < 2:
+                # can't do NNI on this branch
+                return
+        else:
+            assert parent[node1] == node2
+
+            # find uncle
+            uncle = 0
+            if child(node2, uncle) == node1:
+                uncle = 1
+
+        # swap parent and child pointers
+        a = child(node1, change)
+        b = child(node2, uncle)
+        parent[a] = node2
+        parent[b] = node1
+        self._set_child(node2, uncle, a)
+        self._set_child(node1, change, b)
+
+    def perform_spr(self, subtree, newpos):
+        """
+        Performs a Subtree Pruning and Regrafting of 'subtree' onto the
+        branch above 'newpos' (see compbio.phylo.perform_spr)
+        """
+        parent = self.parent
+        child = self._get_child
+
+        a = subtree
+        e = newpos
+
+        c = parent[a]
+        f = parent[c]
+        bi = 1 if child(c, 0) == a else 0
+        b = child(c, bi)
+        ci = 0 if child(f, 0) == c else 1
+        d = parent[e]
+        ei = 0 if child(d, 0) == e else 1
+
+        self._set_child(d, ei, c)
+        self._set_child(c, bi, e)
+        self._set_child(f, ci, b)
+        parent[b] = f
+        parent[c] = d
+        parent[e] = c
+
+
 #=============================================================================
 # Tree visualization
 
@@ -0,0 +1,97 @@
+#
+# Performance metrics for TreeFix searches
+#
+
+import array
+
+#=============================
+# metrics
+
+PERCENTILES = (50, 90, 99)
+
+def percentile(values, p):
+    """returns the p-th percentile (nearest rank) of sorted values"""
+    if len(values) == 0:
+        return None
+    rank = int(-(-p * len(values) // 100))      # ceil(p*n/100)
+    return values[max(rank, 1) - 1]
+
+def ratio(num, denom):
+    """returns num/denom or None if denom is zero"""
+    if denom == 0:
+        return None
+    return float(num) / denom
+
+
+class Metrics (object):
+    """
+    Performance metrics of a gene tree family
+
+    Durations are kept per call of each phase, counters per name, and
+    series (e.g. pool sizes) per search iteration.  Recording a value
+    is a single append or addition so metrics can always be collected.
+    """
+
+    def __init__(self):
+        self.phases = {}        # phase -> array of call durations
+        self.counts = {}        # name -> count
+        self.series = {}        # name -> list of values
+
+    def add_time(self, phase, duration):
+        """record a call of a phase and return its duration"""
+        try:
+            self.phases[phase].append(duration)
+        except KeyError:
+            self.phases[phase] = array.array("d", [duration])
+        return duration
+
+    def count(self, name, n=1):
+        """increase a counter"""
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    def append(self, name, value):
+        """add a value to a series"""
+        self.series.setdefault(name, []).append(value)
+
+    def calls(self, phase):
+        """returns the number of calls of a phase"""
+        return len(self.phases.get(phase, ()))
+
+    def total(self, phase):
+        """returns the total duration of a phase"""
+        return sum(self.phases.get(phase, ()))
+
+    def get_count(self, name):
+        """returns the value of a counter"""
+        return self.counts.get(name, 0)
+
+    def merge(self, other):
+        """add the metrics of another Metrics object (e.g. from a worker)"""
+        for phase, durations in other.phases.iteritems():
+            if phase in self.phases:
+                self.phases[phase].extend(durations)
+            else:
+                self.phases[phase] = array.array("d", durations)
+        for name, n in other.counts.iteritems():
+            self.count(name, n)
+        for name, values in other.series.iteritems():
+            self.series.setdefault(name, []).extend(values)
+
+    def phase_summary(self, phase):
+        """returns the call count, total, mean, and percentiles of a phase"""
+        durations = sorted(self.phases.get(phase, ()))
+        total = sum(durations)
+        summary = {"calls": len(durations),
+                   "total": total,
+                   "mean": ratio(total, len(durations)),
+                   "max": durations[-1] if durations else None}
+        for p in PERCENTILES:
+            summary["p%d" % p] = percentile(durations, p)
+        return summary
+
+    def summary(self):
+        """returns all metrics as a dict (suitable for JSON output)"""
+        return {"phases": dict((phase, self.phase_summary(phase))
+                               for phase in self.phases),
+                "counts": dict(self.counts),
+                "series": dict(self.series)}
@@ -4,6 +4,8 @@
 
 # python libraries
 import optparse, sys
+import collections
+import multiprocessing
 
 # rasmus libraries
 from rasmus import treelib, util
@@ -44,9 +46,52 @@ class StatModel(Model):
         self.rooted = True
         self.parser = None
 
+        # cache of test statistics (disabled if cachesize is 0)
+        self.cachesize = 0
+        self.cache = collections.OrderedDict()
+        self.cache_model = None
+        self.cache_keys = None
+        self.cache_hits = 0
+        self.cache_lookups = 0
+
     def optimize_model(self, gtree, aln):
         """Optimizes the underlying model in the module given the tree and seq (alignment)"""
-        pass
+        self._init_cache(gtree, aln)
+
+    def _init_cache(self, gtree, aln):
+        """Clears the cache of test statistics if the model inputs changed"""
+        keys = phylo.make_fingerprint_keys(gtree.leaf_names())
+        model = (phylo.hash_tree_fingerprint(gtree, keys, rooted=self.rooted),
+                 hash(tuple(sorted(aln.iteritems()))))
+        if model != self.cache_model:
+            self.cache.clear()
+            self.cache_model = model
+            self.cache_keys = keys
+
+    def _cache_key(self, gtree, stat):
+        """Returns the cache key of a tree"""
+        return (phylo.hash_tree_fingerprint(gtree, self.cache_keys, rooted=self.rooted),
+                stat)
+
+    def lookup_lik_test(self, gtree, stat, alternative=None):
+        """Returns the cached test statistic for the tree or None if not cached"""
+        if self.cachesize == 0 or alternative is not None:
+            return None
+        key = self._cache_key(gtree, stat)
+        self.cache_lookups += 1
+        result = self.cache.pop(key, None)
+        if result is not None:
+            self.cache_hits += 1
+            self.cache[key] = result
+        return result
+
+    def store_lik_test(self, gtree, stat, result, alternative=None):
+        """Stores the test statistic for the tree, evicting the least recently used"""
+        if self.cachesize == 0 or alternative is not None:
+            return
+        self.cache[self._cache_key(gtree, stat)] = result
+        if len(self.cache) > self.cachesize:
+            self.cache.popitem(last=False)
 
     def compute_lik_test(self, gtree, stat, alternative=None):
         """
@@ -64,12 +109,57 @@ class CostModel(Model):
         Model.__init__(self, extra)
 
         self.mincost = -util.INF
+        self.incremental = False
         self.parser = None
+        self.stree = None
+        self.gene2species = None
+        self.stree_index = None
+        self.stree_index_file = None    # cache file of the species tree index
+        self.species_nodes = {}     # gene name -> species node
+
+        # memo of costs and rerootings keyed by tree fingerprints
+        # (the least recently used are dropped beyond memosize)
+        self.memosize = 10000
+        self.memo = collections.OrderedDict()
+        self.memo_hits = 0
+        self.memo_lookups = 0
+
+        # worker processes for compute_costs (started for the first list of
+        # at least pool_threshold trees if pool_size > 1)
+        self.pool = None
+        self.pool_size = 1
+        self.pool_threshold = 200
+
+    def optimize_model(self, gtree, stree, gene2species, stree_index=None):
+        """
+        Optimizes the underlying model in the module given the tree.
+        stree_index is a phylo.SpeciesTreeIndex of stree, which is otherwise
+        built (or read from stree_index_file) once per species tree.
+        """
+        if stree is not self.stree or gene2species is not self.gene2species:
+            self.species_nodes = {}
+
+            # workers have a copy of the model for the old species tree
+            self.stop_pool()
 
-    def optimize_model(self, gtree, stree, gene2species):
-        """Optimizes the underlying model in the module given the tree"""
         self.stree = stree
         self.gene2species = gene2species
+        self.memo.clear()
+
+        if stree_index is not None:
+            self.stree_index = stree_index
+        elif self.stree_index is None or self.stree_index.tree is not stree:
+            self.stree_index = phylo.get_species_tree_index(stree,
+                                                            self.stree_index_file)
+
+    def get_species_node(self, gene):
+        """Returns the species node of a gene name (cached)"""
+        try:
+            return self.species_nodes[gene]
+        except KeyError:
+            snode = self.stree_index.species[self.gene2species(gene)]
+            self.species_nodes[gene] = snode
+            return snode
 
     def _reroot_helper(self, gtree, newCopy=True, returnEdge=False):
         """
@@ -93,40 +183,22 @@ class CostModel(Model):
         # make rerooting order consistent using hash ordering
         phylo.hash_order_tree(gtree, self.gene2species)
 
-        # get list of edges to root on
-        edges = []
-        def walk(node):
-            edges.append((node, node.parent))
-            if not node.is_leaf():
-                node.recurse(walk)
-                edges.append((node, node.parent))
-        for child in gtree.root.children:
-            walk(child)
-
         # try initial root
-        treelib.reroot(gtree, edges[0][0].name, newCopy=False)
+        treelib.reroot(gtree, gtree.root.children[0].name, newCopy=False)
         gtree.rename(gtree.root.name, oldroot)
         if returnEdge:
-            yield gtree, edges[0]
+            yield gtree, tuple(gtree.root.children)
         else:
             yield gtree
-        rootedge = sorted(edges[0])
 
-        # try rerooting on everything
-        for edge in edges[1:]:
-            if sorted(edge) == rootedge:
+        # try rerooting on everything (branches revisited by the walk have
+        # the same cost and are skipped)
+        cursor = treelib.RerootCursor(gtree)
+        for changed in cursor:
+            if cursor.revisit:
                 continue
-            rootedge = sorted(edge)
-
-            node1, node2 = edge
-            if node1.parent != node2:
-                node1, node2 = node2, node1
-            assert node1.parent == node2, "%s %s" % (node1.name, node2.name)
-
-            # new root and cost
-            treelib.reroot(gtree, node1.name, newCopy=False, keepName=True)
             if returnEdge:
-                yield gtree, edge
+                yield gtree, tuple(gtree.root.children)
             else:
                 yield gtree
 
@@ -139,14 +211,20 @@ class CostModel(Model):
 
         # try all rerootings
         mincost = util.INF
+        costs = None
         for gtree, edge in self._reroot_helper(gtree, newCopy=newCopy, returnEdge=True):
-            cost = self.compute_cost(gtree)
+            if costs is None:
+                costs = self.rooting_costs(gtree)
+            if costs:
+                cost = costs[frozenset(edge)]
+            else:
+                cost = self.compute_cost(gtree)
             if cost < mincost:
                 mincost = cost
                 minroot = edge
 
         # root tree by minroot
-        if edge != minroot:
+        if set(minroot) != set(gtree.root.children):
             node1, node2 = minroot
             if node1.parent != node2:
                 node1, node2 = node2, node1
@@ -161,3 +239,135 @@ class CostModel(Model):
     def compute_cost(self, gtree):
         """Returns the species tree aware cost."""
         raise
+
+    def rooting_costs(self, gtree):
+        """
+        Returns a dict from each branch of a rooted tree (a frozenset of its
+        two nodes, or of the two children of the root) to the cost of rooting
+        the tree on it.  Models without an incremental computation return {}
+        and recon_root computes the cost of each rooting.
+        """
+        return {}
+
+    def compute_costs(self, gtrees):
+        """
+        Returns the costs of a list of trees (or a treelib.TreeFile).
+        Lists of at least pool_threshold trees are split among the worker
+        processes if pool_size > 1.  Each worker reads its own range of
+        the trees of a TreeFile.
+        """
+        if self.pool_size <= 1 or len(gtrees) < self.pool_threshold:
+            return self._compute_costs(list(gtrees))
+
+        if self.pool is None:
+            self.start_pool()
+        size = -(-len(gtrees) // self.pool_size)
+        chunks = [gtrees[i:i+size] for i in xrange(0, len(gtrees), size)]
+        costs = []
+        for chunk_costs in self.pool.map(_compute_costs_worker, chunks):
+            costs.extend(chunk_costs)
+        return costs
+
+    def _compute_costs(self, gtrees):
+        """Returns the costs of a list of trees (in this process)"""
+        return [self.compute_cost(gtree) for gtree in gtrees]
+
+    def start_pool(self):
+        """
+        Starts pool_size worker processes for compute_costs.
+
+        Must be called after the model is optimized, since each worker
+        inherits a copy of the optimized model when it is forked.
+        """
+        global _pool_model
+
+        self.stop_pool()
+        _pool_model = self
+        self.pool = multiprocessing.Pool(self.pool_size)
+
+    def stop_pool(self):
+        """Stops the worker processes for compute_costs"""
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+    def _lookup_memo(self, key):
+        """Returns the memo value for key or None"""
+        self.memo_lookups += 1
+        value = self.memo.pop(key, None)
+        if value is not None:
+            self.memo_hits += 1
+            self.memo[key] = value
+        return value
+
+    def _store_memo(self, key, value):
+        """Stores a memo value, dropping the least recently used"""
+        if self.memosize == 0:
+            return
+        self.memo[key] = value
+        if len(self.memo) > self.memosize:
+            self.memo.popitem(last=False)
+
+    def memo_compute_cost(self, gtree, key):
+        """
+        Returns the cost of the tree using the memo.
+        'key' must be the rooted fingerprint of the tree.
+        """
+        cost = self._lookup_memo(("cost", key))
+        if cost is None:
+            cost = self.compute_cost(gtree)
+            self._store_memo(("cost", key), cost)
+        return cost
+
+    def memo_recon_root(self, gtree, key, newCopy=True, returnCost=False):
+        """
+        Reroots the tree by minimizing the cost function using the memo.
+        'key' must be the unrooted fingerprint of the tree.
+        """
+        value = self._lookup_memo(("root", key))
+        if value is None:
+            gtree, cost = self.recon_root(gtree, newCopy=newCopy, returnCost=True)
+            self._store_memo(("root", key), (gtree.copy(), cost))
+        else:
+            gtree, cost = value[0].copy(), value[1]
+
+        if returnCost:
+            return gtree, cost
+        else:
+            return gtree
+
+    def init_cost(self, gtree):
+        """
+        Returns the cost of a tree that will be changed in place by local moves.
+        Models that set 'incremental' keep state that update_cost uses.
+        """
+        self.inctree = gtree
+        return self.compute_cost(gtree)
+
+    def update_cost(self, move):
+        """
+        Returns the cost of the tree given to init_cost after it is changed by
+        'move', as given by the 'last_move' of a phylo.TreeSearch.
+        """
+        return self.compute_cost(self.inctree)
+
+    def revert_cost(self):
+        """Undoes the last call to update_cost"""
+        pass
+
+
+# model of the worker processes of CostModel.start_pool
+_pool_model = None
+
+def _compute_costs_worker(gtrees):
+    """
+    Returns the costs of a list of trees (or a treelib.TreeFile) in a
+    worker process
+    """
+    if isinstance(gtrees, treelib.TreeFile):
+        try:
+            return _pool_model._compute_costs(list(gtrees))
+        finally:
+            gtrees.close()
+    return _pool_model._compute_costs(gtrees)
@@ -1,5 +1,5 @@
 #
-# Python module for robinson foulds cost
+# Python module for deep coalescence cost
 #
 
 # treefix libraries
@@ -14,11 +14,16 @@ from rasmus import treelib
 # compbio libraries
 from compbio import phylo
 
-#debug
-import StringIO
 #=============================================================================
 
 class DeepCoalescenceModel(CostModel):
+    """
+    Computes deep coalescence costs
+
+    The number of extra lineages is found from the LCA reconciliation:
+    each gene branch spans the depth difference of the species nodes of its
+    ends, and each species branch is spanned by at least one lineage.
+    """
 
     def __init__(self, extra):
         """Initializes the model"""
@@ -27,9 +32,9 @@ class DeepCoalescenceModel(CostModel):
         self.VERSION = "1.0.1"
         self.mincost = 0
         
-    def optimize_model(self, gtree, stree, gene2species):
+    def optimize_model(self, gtree, stree, gene2species, stree_index=None):
         """Optimizes the model"""
-        CostModel.optimize_model(self, gtree, stree, gene2species)
+        CostModel.optimize_model(self, gtree, stree, gene2species, stree_index)
         
         # ensure gtree and stree are both rooted and binary
         if not (treelib.is_rooted(gtree) and treelib.is_binary(gtree)):
@@ -37,98 +42,72 @@ class DeepCoalescenceModel(CostModel):
         if not (treelib.is_rooted(stree) and treelib.is_binary(stree)):
             raise Exception("species tree must be rooted and binary")
         try:
-            junk = phylo.reconcile(gtree, stree, gene2species)
+            junk = phylo.reconcile(gtree, stree, gene2species, self.stree_index)
         except:
             raise Exception("problem mapping gene tree to species tree")
-    
-    def compute_cost(self, gtree):
-        """Returns the duplication-loss cost"""
-        #recon = phylo.reconcile(gtree, self.stree, self.gene2species)            
-        
+
+    def _reconcile(self, gtree):
+        """Returns the LCA reconciliation of a gene tree"""
+        lca = self.stree_index.lca
         recon = {}
-        
-        def recon_dup(stree, gtree, recon):
-            #Recon plus find duplications in gene tree, for each gene tree leaf we map it to a stree leaf, we also keep track of duplications in the gene tree 
-            leaves = gtree.leaves()
-            for node in leaves:
-                sNode = stree.nodes[self.gene2species(node.name)]
-                recon[node] = sNode
-                
-        #LCA method 
-        def lca(node, lca_dict):
-            """Creates a dictionary of (node, lca) pairs from given tree"""
+        for node in gtree.postorder():
             if node.is_leaf():
-                lca_dict[node] = []
-                lca_dict[node].append(node)
-            
+                recon[node] = self.get_species_node(node.name)
             else:
-                lca_dict[node] = []
-                append = lca_dict[node].append
-                for child in node.children:
-                    lca(child, lca_dict)
-                    for x in lca_dict[child]:
-                        append(x)
-
-        stree_lca_dict = {}
-        gtree_lca_dict = {}
-        
-        geneToSpeciesMap = {}
-        
-        recon_dup( self.stree, gtree, recon)
-        lca(gtree.root, gtree_lca_dict)
-        lca( self.stree.root, stree_lca_dict)
-                       
-        #create a mapping from gene nodes to species nodes
-        for gNodeLca in gtree_lca_dict:
-            if not gNodeLca.is_leaf():
-                gNode = gtree_lca_dict[gNodeLca][0] #Get the first node in the lca 
-                sNode = recon[gNode]
-                
-                gene2speciesLca = []
-                for node in gtree_lca_dict[gNodeLca]:
-                    gene2speciesLca.append(recon[node])
-                
-                found = False
-                    
-                while not found:
-                    
-                    for node in gene2speciesLca:
-                            if node not in stree_lca_dict[sNode]:
-                                break
-                    else:
-                        found = True
-                        geneToSpeciesMap[gNodeLca] = sNode  
-                    
-                    sNode = sNode.parent
-        
-        nodeCount = 0
-        map = {}
-        #count distance
+                recon[node] = lca([recon[child] for child in node.children])
+        return recon
+
+    def compute_cost(self, gtree):
+        """Returns the deep coalescence cost"""
+        recon = self._reconcile(gtree)
+        depths = self.stree_index.depths
+
         count = 0
-        for node in geneToSpeciesMap:
-            nodeCount = 0
-            for child in node.children:
-                
-                if child.is_leaf():
-                    snode = recon[child]
-                else:
-                    snode = geneToSpeciesMap[child]
-                    
-                while snode != geneToSpeciesMap[node]:
-                    nodeCount +=1
-                    snode = snode.parent
-            map[node] = nodeCount
-            count += nodeCount
-        #assuming the number of edges equals the number of nodes - 1 
-        def countChildern(node):
-            count = len(node.children)
-            for child in node.children:
-                count += countChildern(child)
-                
-            return count
-        
-        
-        count = count - countChildern(self.stree.root) 
-       
-        return count
-     
\ No newline at end of file
+        for node in gtree:
+            if node is not gtree.root:
+                count += depths[recon[node]] - depths[recon[node.parent]]
+        return count - (len(self.stree_index.nodes) - 1)
+
+    def rooting_costs(self, gtree):
+        """
+        Returns the deep coalescence cost of rooting the tree on each branch.
+
+        Every node other than the root has one more neighbor than children,
+        so the cost is a sum of the species depths of the nodes weighted by
+        (2 - degree).  Rooting on the branch above a node only changes the
+        species nodes of its ancestors below the root.
+        """
+        recon = self._reconcile(gtree)
+        depths = self.stree_index.depths
+        lca = self.stree_index.lca
+        root = gtree.root
+
+        count = 0
+        for node in gtree:
+            if node is not root:
+                count += depths[recon[node]] - depths[recon[node.parent]]
+        count -= len(self.stree_index.nodes) - 1
+        costs = {frozenset(root.children): count}
+
+        # uprecon[node] is the species LCA of the leaves outside node and
+        # delta[node] is the change in cost from rooting above node
+        uprecon = {}
+        delta = {}
+        for node in gtree.preorder():
+            if node is root:
+                continue
+            parent = node.parent
+            snodes = [recon[x] for x in parent.children if x is not node]
+            if parent is root:
+                uprecon[node] = lca(snodes)
+                delta[node] = 0
+                continue
+            snodes.append(uprecon[parent])
+            uprecon[node] = lca(snodes)
+
+            weight = 1 - len(parent.children)
+            delta[node] = delta[parent] + weight * \
+                (depths[uprecon[node]] - depths[recon[parent]])
+            costs[frozenset((node, parent))] = count + delta[node]
+
+        return costs
@@ -25,6 +25,8 @@ class DupLossModel(CostModel):
 
         self.VERSION = "1.0.1"
         self.mincost = 0
+        self.incremental = True
+        self.compact_stree = None
 
         parser = optparse.OptionParser(prog="DupLossModel")
         parser.add_option("-D", "--dupcost", dest="dupcost",
@@ -39,9 +41,9 @@ class DupLossModel(CostModel):
 
         CostModel._parse_args(self, extra)
 
-    def optimize_model(self, gtree, stree, gene2species):
+    def optimize_model(self, gtree, stree, gene2species, stree_index=None):
         """Optimizes the model"""
-        CostModel.optimize_model(self, gtree, stree, gene2species)
+        CostModel.optimize_model(self, gtree, stree, gene2species, stree_index)
 
         if self.dupcost < 0:
             self.parser.error("-D/--dupcost must be >= 0")
@@ -54,24 +56,150 @@ class DupLossModel(CostModel):
         if not (treelib.is_rooted(stree) and treelib.is_binary(stree)):
             raise Exception("species tree must be rooted and binary")
         try:
-            junk = phylo.reconcile(gtree, stree, gene2species)
+            junk = phylo.reconcile(gtree, stree, gene2species, self.stree_index)
         except:
             raise Exception("problem mapping gene tree to species tree")
 
+        # species ids for compact gene trees
+        if self.compact_stree is None or self.compact_stree.tree is not stree:
+            self.compact_stree = phylo.CompactSpeciesTree(stree, self.stree_index)
+
     def recon_root(self, gtree, newCopy=True, returnCost=False):
         """Reroots the tree by minimizing the duplication/loss cost"""
         return phylo.recon_root(gtree, self.stree, self.gene2species,
                                 newCopy = newCopy,
                                 keepName = True, returnCost = returnCost,
-                                dupcost = self.dupcost, losscost = self.losscost)
+                                dupcost = self.dupcost, losscost = self.losscost,
+                                lca_index = self.stree_index)
+
+    def compact_tree(self, gtree):
+        """Returns a treelib.CompactTree of a gene tree for compute_cost"""
+        return phylo.compact_gene_tree(gtree, self.compact_stree, self.gene2species)
 
     def compute_cost(self, gtree):
-        """Returns the duplication-loss cost"""
-        recon = phylo.reconcile(gtree, self.stree, self.gene2species)
+        """Returns the duplication-loss cost (of a Tree or CompactTree)"""
+        if isinstance(gtree, treelib.CompactTree):
+            return self._compute_compact_cost(gtree)
+
+        recon = phylo.reconcile(gtree, self.stree, self.gene2species, self.stree_index)
         events = phylo.label_events(gtree, recon)
         cost = 0
         if self.dupcost != 0:
             cost += phylo.count_dup(gtree, events) * self.dupcost
         if self.losscost != 0:
-            cost += phylo.count_loss(gtree, self.stree, recon) * self.losscost
+            cost += phylo.count_loss(gtree, self.stree, recon,
+                                     depths=self.stree_index.depths,
+                                     events=events) * self.losscost
         return cost
+
+    def _compute_costs(self, gtrees):
+        """
+        Returns the duplication-loss costs of a list of trees.
+        Rooted binary trees are reconciled together (see phylo.TreeBatch).
+        """
+        costs = [None] * len(gtrees)
+        batch = []
+        for i, gtree in enumerate(gtrees):
+            if treelib.is_rooted(gtree) and treelib.is_binary(gtree):
+                batch.append(i)
+            else:
+                costs[i] = self.compute_cost(gtree)
+        if len(batch) == 0:
+            return costs
+
+        cstree = self.compact_stree
+        trees = phylo.TreeBatch([gtrees[i] for i in batch], cstree,
+                                self.gene2species)
+        recon = phylo.reconcile_batch(trees, cstree)
+        events = phylo.label_events_batch(trees, recon)
+        ndups = phylo.count_dup_batch(trees, events)
+        nloss = phylo.count_loss_batch(trees, cstree, recon, events)
+        for k, i in enumerate(batch):
+            cost = 0
+            if self.dupcost != 0:
+                cost += ndups[k] * self.dupcost
+            if self.losscost != 0:
+                cost += nloss[k] * self.losscost
+            costs[i] = cost
+        return costs
+
+    def _compute_compact_cost(self, ctree):
+        """Returns the duplication-loss cost of a compact gene tree"""
+        recon = phylo.reconcile_compact(ctree, self.compact_stree)
+        events = phylo.label_events_compact(ctree, recon)
+        cost = 0
+        if self.dupcost != 0:
+            cost += phylo.count_dup_compact(ctree, events) * self.dupcost
+        if self.losscost != 0:
+            cost += phylo.count_loss_compact(ctree, self.compact_stree,
+                                             recon, events) * self.losscost
+        return cost
+
+    def _node_counts(self, node):
+        """Returns the dups at a node and the losses on the branches below it"""
+        recon, events = self.recon, self.events
+        depths = self.stree_index.depths
+        ndups = 0
+        if events[node] == "dup":
+            ndups = len(node.children) - 1
+        nloss = 0
+        for child in node.children:
+            nloss += phylo.count_loss_node(child, recon, depths, events)
+        return ndups, nloss
+
+    def _total_cost(self):
+        """Returns the cost from the current dup and loss counts"""
+        cost = 0
+        if self.dupcost != 0:
+            cost += self.ndups * self.dupcost
+        if self.losscost != 0:
+            cost += self.nloss * self.losscost
+        return cost
+
+    def init_cost(self, gtree):
+        """Returns the duplication-loss cost and stores its reconciliation"""
+        self.inctree = gtree
+        self.recon = phylo.reconcile(gtree, self.stree, self.gene2species,
+                                     self.stree_index)
+        self.events = phylo.label_events(gtree, self.recon)
+        self.counts = {}
+        self.ndups = self.nloss = 0
+        for node in gtree:
+            self.counts[node] = self._node_counts(node)
+            self.ndups += self.counts[node][0]
+            self.nloss += self.counts[node][1]
+        self.undo = None
+        return self._total_cost()
+
+    def update_cost(self, move):
+        """
+        Returns the duplication-loss cost after a local move.
+        Only the changed nodes and their ancestors are reconciled again.
+        """
+        recon, events, counts = self.recon, self.events, self.counts
+        lca = self.stree_index.lca
+
+        # update reconciliation from the bottom up
+        nodes = phylo.find_changed_ancestors(move[1])
+        self.undo = ([(node, recon[node], events[node], counts[node])
+                      for node in nodes], self.ndups, self.nloss)
+        for node in nodes:
+            recon[node] = lca([recon[x] for x in node.children])
+            events[node] = phylo.label_events_node(node, recon)
+            ndups, nloss = self._node_counts(node)
+            self.ndups += ndups - counts[node][0]
+            self.nloss += nloss - counts[node][1]
+            counts[node] = (ndups, nloss)
+
+        return self._total_cost()
+
+    def revert_cost(self):
+        """Undoes the last call to update_cost"""
+        if self.undo is None:
+            return
+        nodes, self.ndups, self.nloss = self.undo
+        for node, snode, event, count in nodes:
+            self.recon[node] = snode
+            self.events[node] = event
+            self.counts[node] = count
+        self.undo = None
@@ -14,12 +14,22 @@ from rasmus import treelib
 # compbio libraries
 from compbio import phylo
 
-#debug
-import StringIO
 #=============================================================================
 
 class MulRFModel(CostModel):
-    """Computes Robinson-Foulds or MulRF costs"""
+    """
+    Computes Robinson-Foulds or MulRF costs
+
+    The species tree is extended to a MUL-tree by replacing each species
+    leaf with k > 1 gene copies by a new node with k copies of the leaf.
+    The cost counts the clusters (leaf multisets) of the non-root nodes of
+    the gene tree and the MUL-tree that do not match.
+
+    The gene leaves below a gene node always form a sub-multiset of the
+    MUL-tree cluster of their species LCA, so a gene cluster is encoded by
+    its species LCA and size, and matches iff its size equals that of the
+    MUL-tree cluster.
+    """
 
     def __init__(self, extra):
         """Initializes the model"""
@@ -27,12 +37,10 @@ class MulRFModel(CostModel):
 
         self.VERSION = "1.0.1"
         self.mincost = 0
-        self.count = 0
-        self.log = open('matched.txt', 'w')
         
-    def optimize_model(self, gtree, stree, gene2species):
+    def optimize_model(self, gtree, stree, gene2species, stree_index=None):
         """Optimizes the model"""
-        CostModel.optimize_model(self, gtree, stree, gene2species)
+        CostModel.optimize_model(self, gtree, stree, gene2species, stree_index)
         
         # ensure gtree and stree are both rooted and binary
         if not (treelib.is_rooted(gtree) and treelib.is_binary(gtree)):
@@ -40,106 +48,117 @@ class MulRFModel(CostModel):
         if not (treelib.is_rooted(stree) and treelib.is_binary(stree)):
             raise Exception("species tree must be rooted and binary")
         try:
-            junk = phylo.reconcile(gtree, stree, gene2species)
+            junk = phylo.reconcile(gtree, stree, gene2species, self.stree_index)
         except:
             raise Exception("problem mapping gene tree to species tree")
-    
-    def compute_cost(self, gtree):
-        """Returns the duplication-loss cost"""
-        #recon = phylo.reconcile(gtree, self.stree, self.gene2species)            
-        
+
+    def _encode(self, gtree):
+        """
+        Returns the species LCA, size, and number of leaves mapped to
+        internal species nodes (which match no MUL-tree cluster) of the
+        cluster of each gene node, and the MUL-tree cost of the gene tree
+        apart from matches
+        """
+        lca = self.stree_index.lca
         recon = {}
-        find_dup = {}
-        streeCopy = self.stree.copy()
-        
-        def recon_dup(stree, gtree, recon, dup):
-            #Recon plus find duplications in gene tree, for each gene tree leaf we map it to a stree leaf, we also keep track of duplications in the gene tree 
-            leaves = gtree.leaves()
-            for node in leaves:
-                sNode = stree.nodes[self.gene2species(node.name)]
-                recon[node] = sNode
-                if not sNode in dup:
-                    dup[sNode] = []
-                dup[sNode].append(node)
-                   
-        def duplicate_nodes(tree, find_dup):
-            #make modifications to the streeCopy to acount for duplications
-            
-            leaves = tree.leaves()
-            for node in leaves:
-                if node in find_dup and len(find_dup[node]) > 1:
-                    #remove node from the parent's children list, create a new parent and append it the the old parent's children list 
-                    node.parent.children.remove(node)
-                    parent = treelib.TreeNode(name = streeCopy.new_name())
-                    node.parent.children.append(parent)
-                
-                    count = 0 
-                    #add a copy of the node to the new parent for each copy in the gene tree
-                    append = parent.children.append
-                    while count < len(find_dup[node]):
-                        count = count + 1
-                        append(node)
-         
-        def printLca(tree, lca):
-
-            for node in lca:
-                if  len(node.leaves()) > 1 and (node is not tree.root):
-                    print >> self.log, node
-                    print >> self.log, lca[node]
-        
-        #LCA method 
-        def lca(node, lca_dict):
-            """Creates a dictionary of (node, lca) pairs from given tree"""
+        sizes = {}
+        bad = {}
+        copies = {}         # species leaf -> number of gene copies
+        ninternal = 0
+
+        for node in gtree.postorder():
             if node.is_leaf():
-                lca_dict[node] = []
-                lca_dict[node].append(node)
-            
-            else:
-                lca_dict[node] = []
-                append = lca_dict[node].append
-                for child in node.children:
-                    lca(child, lca_dict)
-                    for x in lca_dict[child]:
-                        append(x)
-
-        stree_lca_dict = {}
-        gtree_lca_dict = {}
-        
-        recon_dup(streeCopy, gtree, recon, find_dup)
-        duplicate_nodes(streeCopy, find_dup)
-        lca(gtree.root, gtree_lca_dict)
-        lca(streeCopy.root, stree_lca_dict)
-                     
-        cost = len(stree_lca_dict) + (len(gtree_lca_dict) - len(gtree.leaves()) - 1 )
-        
-        
-        for sNode in stree_lca_dict:
-            #check leaf or root
-            if len(stree_lca_dict[sNode]) > 1 and sNode != streeCopy.root:
-                for gNode in gtree_lca_dict:
-                    if len(stree_lca_dict[sNode]) == len(gtree_lca_dict[gNode]) and gNode != gtree.root:
-                    
-                        #Used to evaluate if the lca matches exactly.
-                        stree_lca = []
-                        for x in stree_lca_dict[sNode]:
-                            stree_lca.append(x)
-                    
-                        match = True
-                    
-                        for node in gtree_lca_dict[gNode]:
-                            if recon[node] not in stree_lca:
-                                match = False
-                                break
-                            else:
-                                stree_lca.remove(recon[node])
-                    
-                        if match:
-                            #print >> self.log, stree_lca_dict[sNode]
-                            cost = cost - 2
-            #if node is a leaf or the root we subtract one, because we dont count the them 
+                snode = self.get_species_node(node.name)
+                recon[node] = snode
+                sizes[node] = 1
+                if snode.is_leaf():
+                    bad[node] = 0
+                    copies[snode] = copies.get(snode, 0) + 1
+                else:
+                    bad[node] = 1
             else:
-                cost  = cost - 1
-       
-        
+                recon[node] = lca([recon[child] for child in node.children])
+                sizes[node] = sum(sizes[child] for child in node.children)
+                bad[node] = sum(bad[child] for child in node.children)
+                ninternal += 1
+
+        # extra MUL-tree cluster size of species nodes above duplicated leaves
+        extra = {}
+        ndups = 0
+        for snode, k in copies.iteritems():
+            if k > 1:
+                ndups += 1
+                while snode:
+                    extra[snode] = extra.get(snode, 0) + k - 1
+                    snode = snode.parent
+
+        # non-root MUL-tree clusters of size > 1 and non-root gene clusters
+        # (all unmatched, see compute_cost)
+        index = self.stree_index
+        ninternal_species = len(index.nodes) - index.sizes[self.stree.root]
+        cost = (ninternal_species - 1 + ndups) + (ninternal - 1)
+        return recon, sizes, bad, extra, cost
+
+    def _match(self, snode, size, nbad, extra):
+        """
+        Returns 1 if the gene cluster with species LCA 'snode', 'size'
+        leaves, and 'nbad' leaves mapped to internal species nodes matches
+        a non-root MUL-tree cluster of size > 1, otherwise 0
+        """
+        if nbad == 0 and size > 1 and snode is not self.stree.root and \
+           size == self.stree_index.sizes[snode] + extra.get(snode, 0):
+            return 1
+        return 0
+
+    def compute_cost(self, gtree):
+        """Returns the MulRF cost"""
+        recon, sizes, bad, extra, cost = self._encode(gtree)
+
+        # each matching pair of clusters is not counted
+        for node in gtree:
+            if node is not gtree.root:
+                cost -= 2 * self._match(recon[node], sizes[node], bad[node], extra)
         return cost
-     
\ No newline at end of file
+
+    def rooting_costs(self, gtree):
+        """
+        Returns the MulRF cost of rooting the tree on each branch.
+
+        Rooting on the branch above a node changes the clusters of its
+        ancestors below the root to the leaves outside their child on the
+        path, so the cost changes by the matches of those clusters.
+        """
+        recon, sizes, bad, extra, cost = self._encode(gtree)
+        match = self._match
+        lca = self.stree_index.lca
+        root = gtree.root
+        nleaves = sizes[root]
+        nbad = bad[root]
+
+        for node in gtree:
+            if node is not root:
+                cost -= 2 * match(recon[node], sizes[node], bad[node], extra)
+        costs = {frozenset(root.children): cost}
+
+        # uprecon[node] is the species LCA of the leaves outside node and
+        # gain[node] is the change in matches from rooting above node
+        uprecon = {}
+        gain = {}
+        for node in gtree.preorder():
+            if node is root:
+                continue
+            parent = node.parent
+            snodes = [recon[x] for x in parent.children if x is not node]
+            if parent is root:
+                uprecon[node] = lca(snodes)
+                gain[node] = 0
+                continue
+            snodes.append(uprecon[parent])
+            uprecon[node] = lca(snodes)
+
+            gain[node] = gain[parent] + \
+                match(uprecon[node], nleaves - sizes[node], nbad - bad[node], extra) - \
+                match(recon[parent], sizes[parent], bad[parent], extra)
+            costs[frozenset((node, parent))] = cost - 2 * gain[node]
+
+        return costs
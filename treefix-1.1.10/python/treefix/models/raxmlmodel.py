@@ -40,10 +40,17 @@ class RAxMLModel(StatModel):
                           metavar="<eps>",
                           default=2.0, type="float",
                           help="model optimization precision in log likelihood units (default 2.0)")
+        parser.add_option("--cachesize", dest="cachesize",
+                          metavar="<cache size>",
+                          default=10000, type="int",
+                          help="number of test statistics to cache (default 10000, 0 to disable)")
         self.parser = parser
 
         StatModel._parse_args(self, extra)
 
+        if self.cachesize < 0:
+            self.parser.error("--cachesize must be >= 0")
+
     def __del__(self):
         """Cleans up the RAxML model"""
         del self._raxml
@@ -70,4 +77,8 @@ class RAxMLModel(StatModel):
 
     def compute_lik_test(self, gtree, stat="SH", alternative=None):
         """Computes the test statistic 'stat' using RAxML likelihoods"""
-        return self._raxml.compute_lik_test(gtree, stat, alternative)
+        result = self.lookup_lik_test(gtree, stat, alternative)
+        if result is None:
+            result = self._raxml.compute_lik_test(gtree, stat, alternative)
+            self.store_lik_test(gtree, stat, result, alternative)
+        return result